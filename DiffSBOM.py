@@ -1,11 +1,175 @@
 import sys
 import os
+import copy
 import json
+import hashlib
+import hmac
+import mmap
+import sqlite3
 import subprocess
 import shutil
+import signal
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+import gzip
+import io
+import multiprocessing
+import re
+import secrets
+import socket
+import socketserver
+import http.client
+import tarfile
+import zipfile
+import heapq
+import importlib
+import resource
+import traceback
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.connection import wait as wait_sentinels
 from pathlib import Path
 
+def _children_cpu():
+    t = os.times()
+    return t.children_user + t.children_system
+
+class Tracer:
+    """Per-phase and per-file timings, written as a JSON-lines trace.
+
+    A disabled tracer ignores every call, so instrumented code only pays an
+    attribute check when tracing is off. Phases may overlap (the scanner
+    runs alongside the diffs), and CPU time is process-wide, so the CPU of
+    concurrent phases is counted in each of them.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.out = None
+        self.hooks = []
+        self.slowest = 10
+        self.files = []
+        self.subprocesses = Counter()
+
+    def configure(self, path=None, hooks=(), slowest=10):
+        self.enabled = True
+        self.out = open(path, "w", encoding="utf-8", buffering=1) if path else None
+        self.hooks = list(hooks)
+        self.slowest = slowest
+        self.files = []
+        self.subprocesses = Counter()
+        self.started = (time.perf_counter(), time.process_time(), _children_cpu())
+
+    def emit(self, event):
+        event = {"ts": round(time.time(), 6), **event}
+        with self.lock:
+            if self.out is not None:
+                self.out.write(json.dumps(event, ensure_ascii=False) + "\n")
+            hooks = list(self.hooks)
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                print(f"[WARN] Metrics hook {hook!r} failed and was removed: {e}")
+                with self.lock:
+                    if hook in self.hooks:
+                        self.hooks.remove(hook)
+
+    def record_phase(self, name, wall, cpu=None, children_cpu=None, **extra):
+        if not self.enabled:
+            return
+        event = {"event": "phase", "name": name, "wall": round(wall, 6)}
+        if cpu is not None:
+            event["cpu"] = round(cpu, 6)
+            event["children_cpu"] = round(children_cpu, 6)
+        event.update(extra)
+        self.emit(event)
+
+    @contextmanager
+    def phase(self, name, **extra):
+        if not self.enabled:
+            yield
+            return
+        wall, cpu, children = time.perf_counter(), time.process_time(), _children_cpu()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.perf_counter() - wall, time.process_time() - cpu,
+                              _children_cpu() - children, **extra)
+
+    def record_file(self, path, engine, seconds, size, error=False):
+        if not self.enabled:
+            return
+        event = {"event": "file", "file": str(path), "engine": engine, "wall": round(seconds, 6), "bytes": size}
+        if error:
+            event["error"] = True
+        with self.lock:
+            item = (seconds, str(path), engine, size)
+            if len(self.files) < self.slowest:
+                heapq.heappush(self.files, item)
+            elif self.files and item > self.files[0]:
+                heapq.heapreplace(self.files, item)
+        self.emit(event)
+
+    def count_subprocess(self, program):
+        if self.enabled:
+            with self.lock:
+                self.subprocesses[os.path.basename(str(program))] += 1
+
+    def finish(self):
+        if not self.enabled:
+            return
+        wall, cpu, children = self.started
+        slowest = [{"file": f, "engine": e, "wall": round(t, 6), "bytes": b}
+                   for t, f, e, b in sorted(self.files, reverse=True)]
+        summary = {
+            "event": "summary",
+            "wall": round(time.perf_counter() - wall, 6),
+            "cpu": round(time.process_time() - cpu, 6),
+            "children_cpu": round(_children_cpu() - children, 6),
+            "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "children_peak_rss_kib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            "subprocesses": dict(self.subprocesses),
+            "slowest_files": slowest,
+        }
+        self.emit(summary)
+        print(f"[INFO] Finished in {summary['wall']:.2f}s (cpu {summary['cpu']:.2f}s, "
+              f"subprocess cpu {summary['children_cpu']:.2f}s, peak RSS {summary['peak_rss_kib']} KiB)")
+        if summary["subprocesses"]:
+            counts = ", ".join(f"{k}={v}" for k, v in sorted(summary["subprocesses"].items()))
+            print(f"[INFO] Subprocesses: {counts}")
+        if slowest:
+            print(f"[INFO] Slowest {len(slowest)} file diffs:")
+            for item in slowest:
+                print(f"  {item['wall']:9.3f}s  {item['bytes']:>10} B  {item['engine']:<10} {item['file']}")
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        self.enabled = False
+
+TRACER = Tracer()
+
+def load_metrics_hook(spec):
+    module, _, name = spec.partition(":")
+    try:
+        hook = getattr(importlib.import_module(module), name or "emit")
+    except (ImportError, AttributeError) as e:
+        print(f"[ERROR] Could not load metrics hook '{spec}': {e}")
+        sys.exit(1)
+    if not callable(hook):
+        print(f"[ERROR] Metrics hook '{spec}' is not callable.")
+        sys.exit(1)
+    return hook
+
 def run_command_capture(cmd, timeout=120):
+    TRACER.count_subprocess(cmd[0])
     try:
         r = subprocess.run(
             cmd,
@@ -19,10 +183,15 @@ def run_command_capture(cmd, timeout=120):
     except Exception as e:
         return "", str(e), 1
 
+_FOUND_TOOLS = set()
+
 def ensure_tool_exists(tool):
+    if tool in _FOUND_TOOLS:
+        return
     if shutil.which(tool) is None:
         print(f"[ERROR] Required tool not found on PATH: {tool}")
         sys.exit(1)
+    _FOUND_TOOLS.add(tool)
 
 def is_source_file(path):
     return path.endswith((
@@ -35,24 +204,861 @@ def is_source_file(path):
         '.cs'
     ))
 
-def run_diffoscope(old_file, new_file):
+DIFFOSCOPE_FORMATS = ("text", "json")
+
+DiffRecord = namedtuple("DiffRecord", "source1 source2 depth comments hunks")
+
+def parse_diffoscope_json(report):
+    records = []
+    stack = [(report, 0)]
+    while stack:
+        node, depth = stack.pop()
+        hunks = []
+        for line in (node.get("unified_diff") or "").splitlines():
+            if line.startswith("@@"):
+                hunks.append((line, []))
+            elif hunks:
+                hunks[-1][1].append(line)
+        records.append(DiffRecord(node.get("source1", ""), node.get("source2", ""), depth,
+                                  list(node.get("comments") or []), hunks))
+        stack.extend((child, depth + 1) for child in reversed(node.get("details") or []))
+    return records
+
+def render_diff_records(records):
+    # Mirrors diffoscope's text presenter so both output formats produce
+    # the same "change" lines and diff_output.txt.
+    lines = []
+    for record in records:
+        head = "│ " * max(record.depth - 1, 0)
+        body = "│ " * record.depth
+        if record.depth == 0:
+            lines.append(f"--- {record.source1}")
+            lines.append(f"+++ {record.source2}")
+        elif record.source1 == record.source2:
+            lines.append(f"{head}├── {record.source1}")
+        else:
+            lines.append(f"{head}│   --- {record.source1}")
+            lines.append(f"{head}├── +++ {record.source2}")
+        lines.extend(f"{head}│┄ {line}" for comment in record.comments for line in comment.splitlines())
+        for header, hunk_lines in record.hunks:
+            lines.append(body + header)
+            lines.extend(body + line for line in hunk_lines)
+    return lines
+
+DIFFOSCOPE_TIMEOUT = 60
+
+def _diffoscope_worker(conn):
+    # Child process of DiffoscopeLibrary: import diffoscope and build its
+    # comparator registry once, then serve comparisons until the pipe closes.
+    try:
+        from diffoscope.comparators import ComparatorManager
+        from diffoscope.comparators.utils.compare import compare_root_paths
+        from diffoscope.config import Config
+        from diffoscope.presenters.json import JSONPresenter
+        from diffoscope.presenters.text import TextPresenter
+        try:
+            from diffoscope.environ import normalize_environment
+        except ImportError:
+            # Older releases call it set_locale.
+            try:
+                from diffoscope.locale import set_locale as normalize_environment
+            except ImportError:
+                normalize_environment = None
+        if normalize_environment is not None:
+            normalize_environment()
+        ComparatorManager().reload()
+    except Exception as e:
+        conn.send(("unavailable", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", None))
+    while True:
+        try:
+            old_file, new_file, output_format = conn.recv()
+        except EOFError:
+            return
+        out = io.StringIO()
+
+        def print_func(*args, **kwargs):
+            print(*args, file=out, **kwargs)
+
+        # The command's default --exclude-directory-metadata=auto: metadata
+        # is only compared when both paths are directories.
+        both_dirs = os.path.isdir(old_file) and os.path.isdir(new_file)
+        Config().exclude_directory_metadata = "no" if both_dirs else "yes"
+        try:
+            difference = compare_root_paths(old_file, new_file)
+            if difference is not None:
+                if output_format == "json":
+                    JSONPresenter(print_func).start(difference)
+                else:
+                    TextPresenter(print_func, False).start(difference)
+            conn.send(("ok", out.getvalue()))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+class DiffoscopeLibrary:
+    """Run diffoscope's comparison API in long-lived worker processes.
+
+    Each call borrows an idle worker and hands it back when done, so
+    diffoscope is imported and its comparator registry built once per
+    worker rather than once per file, and there are never more workers
+    than concurrent diffs. Workers outlive the thread pools that use them,
+    which lets serve mode keep them across jobs. A call that overruns the
+    timeout kills its worker; the next call starts a fresh one. If the
+    workers cannot import diffoscope, `available` drops to False and
+    callers fall back to the diffoscope command.
+    """
+    def __init__(self, timeout=DIFFOSCOPE_TIMEOUT):
+        self.timeout = timeout
+        self.available = True
+        self.lock = threading.Lock()
+        self.workers = []
+        self.idle = []
+
+    def _worker(self):
+        with self.lock:
+            while self.idle:
+                worker = self.idle.pop()
+                if worker[0].is_alive():
+                    return worker
+                self.workers.remove(worker)
+        ctx = multiprocessing.get_context("spawn")
+        conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(target=_diffoscope_worker, args=(child_conn,), daemon=True)
+        proc.start()
+        child_conn.close()
+        TRACER.count_subprocess("diffoscope-worker")
+        try:
+            status, detail = conn.recv() if conn.poll(self.timeout) else ("unavailable", "worker did not start")
+        except EOFError:
+            status, detail = "unavailable", "worker exited during startup"
+        if status != "ready":
+            proc.kill()
+            proc.join()
+            with self.lock:
+                if self.available:
+                    self.available = False
+                    print(f"[WARN] diffoscope library unavailable, using the diffoscope command: {detail}")
+            return None
+        with self.lock:
+            self.workers.append((proc, conn))
+        return proc, conn
+
+    def capture(self, old_file, new_file, output_format="text"):
+        """Return what `diffoscope [--json -] old new` would print, or None if unavailable."""
+        worker = self._worker()
+        if worker is None:
+            return None
+        proc, conn = worker
+        conn.send((str(old_file), str(new_file), output_format))
+        try:
+            if not conn.poll(self.timeout):
+                raise TimeoutError(f"diffoscope timed out after {self.timeout} seconds")
+            status, payload = conn.recv()
+        except (TimeoutError, EOFError):
+            proc.kill()
+            proc.join()
+            with self.lock:
+                self.workers.remove(worker)
+            raise
+        with self.lock:
+            self.idle.append(worker)
+        if status != "ok":
+            raise RuntimeError(payload)
+        return payload
+
+    def close(self):
+        with self.lock:
+            workers, self.workers, self.idle = self.workers, [], []
+        for proc, conn in workers:
+            conn.close()
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.kill()
+
+DIFFOSCOPE_LIBRARY = None
+
+def _diffoscope_result(stdout, output_format, stderr=""):
+    if output_format != "json":
+        return stdout, stdout.splitlines(), None
+    # The file pair is known to differ, so a missing report means diffoscope
+    # failed rather than found nothing.
+    if not stdout.strip():
+        detail = stderr.strip() or "empty JSON report"
+        return None, [f"[ERROR] Failed to run diffoscope: {detail}"], None
+    try:
+        report = json.loads(stdout)
+    except ValueError as e:
+        return None, [f"[ERROR] Failed to run diffoscope: invalid JSON report: {e}"], None
+    records = parse_diffoscope_json(report)
+    lines = render_diff_records(records)
+    return "\n".join(lines) + "\n", lines, records
+
+def _diffoscope_capture(old_file, new_file, output_format="text"):
+    library = DIFFOSCOPE_LIBRARY
+    if library is not None and library.available:
+        try:
+            stdout = library.capture(old_file, new_file, output_format)
+            if stdout is not None:
+                return _diffoscope_result(stdout, output_format)
+        except Exception as e:
+            return None, [f"[ERROR] Failed to run diffoscope: {e}"], None
     if shutil.which("diffoscope") is None:
-        return [f"[WARN] diffoscope not found; raw change recorded for {old_file} -> {new_file}"]
+        return None, [f"[WARN] diffoscope not found; raw change recorded for {old_file} -> {new_file}"], None
+    cmd = ["diffoscope", str(old_file), str(new_file)]
+    if output_format == "json":
+        cmd[1:1] = ["--json", "-"]
+    TRACER.count_subprocess("diffoscope")
     try:
         result = subprocess.run(
-            ["diffoscope", str(old_file), str(new_file)],
+            cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
-            timeout=60
+            timeout=DIFFOSCOPE_TIMEOUT
         )
+        return _diffoscope_result(result.stdout, output_format, result.stderr)
+    except Exception as e:
+        return None, [f"[ERROR] Failed to run diffoscope: {e}"], None
+
+def _write_diff_output(f, text):
+    f.write(text)
+    if not text.endswith("\n"):
+        f.write("\n")
+
+def run_diffoscope(old_file, new_file, engine="diffoscope", diff_cache=None, old_hash=None, new_hash=None,
+                   diffoscope_format="text"):
+    text, lines, _ = cached_diff_capture(old_file, new_file, engine, diff_cache, old_hash, new_hash,
+                                         diffoscope_format)
+    if text is None:
+        return lines
+    try:
         with open("diff_output.txt", "a", encoding="utf-8", errors="replace") as f:
-            f.write(result.stdout)
-            if not result.stdout.endswith("\n"):
-                f.write("\n")
-        return result.stdout.splitlines()
+            _write_diff_output(f, text)
     except Exception as e:
         return [f"[ERROR] Failed to run diffoscope: {e}"]
+    return lines
+
+DIFF_ENGINES = ("diffoscope", "builtin", "auto")
+DIFF_CONTEXT_LINES = 7
+ARCHIVE_SUFFIXES = (
+    '.zip', '.jar', '.war', '.whl', '.egg', '.apk', '.aar', '.nupkg',
+    '.tar', '.tgz', '.gz', '.bz2', '.xz', '.zst', '.lz', '.lzma', '.7z',
+    '.deb', '.rpm', '.cpio', '.iso', '.squashfs', '.crate', '.gem',
+)
+
+def _split_lines(data):
+    lines = data.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+        return [line + b"\n" for line in lines]
+    return [line + b"\n" for line in lines[:-1]] + [lines[-1]]
+
+def is_text_content(path, data):
+    if str(path).lower().endswith(ARCHIVE_SUFFIXES):
+        return False
+    return b"\0" not in data[:8192]
+
+def _common_prefix_len(x, y):
+    n = min(len(x), len(y))
+    lo = 0
+    while lo < n:
+        hi = min(n, lo + 4096)
+        if x[lo:hi] != y[lo:hi]:
+            while x[lo] == y[lo]:
+                lo += 1
+            return lo
+        lo = hi
+    return n
+
+def _common_suffix_len(x, y, limit):
+    n0, n1 = len(x), len(y)
+    s = 0
+    while s < limit:
+        step = min(limit - s, 4096)
+        if x[n0 - s - step:n0 - s] != y[n1 - s - step:n1 - s]:
+            while x[n0 - s - 1] == y[n1 - s - 1]:
+                s += 1
+            return s
+        s += step
+    return limit
+
+def _identical_ends(buf0, buf1, missing0, missing1, horizon):
+    """Return (prefix_end, suffix_begin0, suffix_begin1) byte offsets the way
+    GNU diff's find_identical_ends trims the inputs, keeping `horizon` lines."""
+    nl = ord("\n")
+    n0, n1 = len(buf0), len(buf1)
+    p = _common_prefix_len(buf0, buf1)
+    if (n0 - missing0 < p) != (n1 - missing1 < p):
+        p -= 1
+    i = horizon
+    while p:
+        if buf0[p - 1] == nl:
+            if not i:
+                break
+            i -= 1
+        p -= 1
+    if missing0 != missing1:
+        return p, n0, n1
+    s = _common_suffix_len(buf0, buf1, min(n0, n1) - p)
+    p0, p1 = n0 - s, n1 - s
+    i = horizon + (not ((p0 == 0 or buf0[p0 - 1] == nl) and (p1 == 0 or buf1[p1 - 1] == nl)))
+    q0 = p0
+    while i and q0 != n0:
+        i -= 1
+        q0 = buf0.index(b"\n", q0) + 1
+    return p, q0, p1 + (q0 - p0)
+
+def _discard_confusing_lines(equivs):
+    """Mark lines with no match on the other side (1) or too many matches (2),
+    then keep only the discards GNU diff keeps; returns the two flag lists."""
+    counts = []
+    for f in (0, 1):
+        c = {}
+        for e in equivs[f]:
+            c[e] = c.get(e, 0) + 1
+        counts.append(c)
+    discarded = []
+    for f in (0, 1):
+        end = len(equivs[f])
+        other = counts[1 - f]
+        many = 5
+        tem = end // 64
+        while True:
+            tem >>= 2
+            if not tem:
+                break
+            many *= 2
+        flags = []
+        for e in equivs[f]:
+            nmatch = other.get(e, 0)
+            flags.append(1 if nmatch == 0 else 2 if nmatch > many else 0)
+        discarded.append(flags)
+
+    for discards in discarded:
+        end = len(discards)
+        i = 0
+        while i < end:
+            if discards[i] == 2:
+                discards[i] = 0
+            elif discards[i]:
+                provisional = 0
+                j = i
+                while j < end and discards[j]:
+                    if discards[j] == 2:
+                        provisional += 1
+                    j += 1
+                while j > i and discards[j - 1] == 2:
+                    j -= 1
+                    discards[j] = 0
+                    provisional -= 1
+                length = j - i
+                if provisional * 4 > length:
+                    while j > i:
+                        j -= 1
+                        if discards[j] == 2:
+                            discards[j] = 0
+                else:
+                    minimum = 1
+                    tem = length >> 2
+                    while True:
+                        tem >>= 2
+                        if not tem:
+                            break
+                        minimum <<= 1
+                    minimum += 1
+                    j = consec = 0
+                    while j < length:
+                        if discards[i + j] != 2:
+                            consec = 0
+                        else:
+                            consec += 1
+                            if consec == minimum:
+                                j -= consec
+                            elif consec > minimum:
+                                discards[i + j] = 0
+                        j += 1
+                    consec = 0
+                    for j in range(length):
+                        if j >= 8 and discards[i + j] == 1:
+                            break
+                        if discards[i + j] == 2:
+                            consec = 0
+                            discards[i + j] = 0
+                        elif discards[i + j] == 0:
+                            consec = 0
+                        else:
+                            consec += 1
+                        if consec == 3:
+                            break
+                    i += length - 1
+                    consec = 0
+                    for j in range(length):
+                        if j >= 8 and discards[i - j] == 1:
+                            break
+                        if discards[i - j] == 2:
+                            consec = 0
+                            discards[i - j] = 0
+                        elif discards[i - j] == 0:
+                            consec = 0
+                        else:
+                            consec += 1
+                        if consec == 3:
+                            break
+            i += 1
+    return discarded
+
+def _diag(xv, yv, xoff, xlim, yoff, ylim, find_minimal, fd, bd, too_expensive):
+    """Find the midpoint of the shortest edit script for a box of xv/yv,
+    using GNU diff's forward/backward search order and its cost cutoff."""
+    dmin = xoff - ylim
+    dmax = xlim - yoff
+    fmid = xoff - yoff
+    bmid = xlim - ylim
+    fmin = fmax = fmid
+    bmin = bmax = bmid
+    odd = (fmid - bmid) & 1
+    fd[fmid] = xoff
+    bd[bmid] = xlim
+    big = xlim + ylim + 1
+    c = 0
+    while True:
+        c += 1
+        if fmin > dmin:
+            fmin -= 1
+            fd[fmin - 1] = -1
+        else:
+            fmin += 1
+        if fmax < dmax:
+            fmax += 1
+            fd[fmax + 1] = -1
+        else:
+            fmax -= 1
+        for d in range(fmax, fmin - 1, -2):
+            tlo = fd[d - 1]
+            thi = fd[d + 1]
+            x = thi if tlo < thi else tlo + 1
+            y = x - d
+            while x < xlim and y < ylim and xv[x] == yv[y]:
+                x += 1
+                y += 1
+            fd[d] = x
+            if odd and bmin <= d <= bmax and bd[d] <= x:
+                return x, y, True, True
+
+        if bmin > dmin:
+            bmin -= 1
+            bd[bmin - 1] = big
+        else:
+            bmin += 1
+        if bmax < dmax:
+            bmax += 1
+            bd[bmax + 1] = big
+        else:
+            bmax -= 1
+        for d in range(bmax, bmin - 1, -2):
+            tlo = bd[d - 1]
+            thi = bd[d + 1]
+            x = tlo if tlo < thi else thi - 1
+            y = x - d
+            while xoff < x and yoff < y and xv[x - 1] == yv[y - 1]:
+                x -= 1
+                y -= 1
+            bd[d] = x
+            if not odd and fmin <= d <= fmax and x <= fd[d]:
+                return x, y, True, True
+
+        if find_minimal or c < too_expensive:
+            continue
+        fxybest = -1
+        fxbest = 0
+        for d in range(fmax, fmin - 1, -2):
+            x = min(fd[d], xlim)
+            y = x - d
+            if ylim < y:
+                x = ylim + d
+                y = ylim
+            if fxybest < x + y:
+                fxybest = x + y
+                fxbest = x
+        bxybest = big + xlim + ylim
+        bxbest = 0
+        for d in range(bmax, bmin - 1, -2):
+            x = max(xoff, bd[d])
+            y = x - d
+            if y < yoff:
+                x = yoff + d
+                y = yoff
+            if x + y < bxybest:
+                bxybest = x + y
+                bxbest = x
+        if (xlim + ylim) - bxybest < fxybest - (xoff + yoff):
+            return fxbest, fxybest - fxbest, True, False
+        return bxbest, bxybest - bxbest, False, True
+
+def _compareseq(xv, yv, too_expensive):
+    """Return the indexes of xv and yv that are not part of the common subsequence."""
+    deleted, inserted = [], []
+    # Furthest-reaching x per diagonal, keyed by diagonal (which may be negative).
+    fd, bd = {}, {}
+    stack = [(0, len(xv), 0, len(yv), False)]
+    while stack:
+        xoff, xlim, yoff, ylim, find_minimal = stack.pop()
+        while xoff < xlim and yoff < ylim and xv[xoff] == yv[yoff]:
+            xoff += 1
+            yoff += 1
+        while xoff < xlim and yoff < ylim and xv[xlim - 1] == yv[ylim - 1]:
+            xlim -= 1
+            ylim -= 1
+        if xoff == xlim:
+            inserted.extend(range(yoff, ylim))
+        elif yoff == ylim:
+            deleted.extend(range(xoff, xlim))
+        else:
+            xmid, ymid, lo_minimal, hi_minimal = _diag(
+                xv, yv, xoff, xlim, yoff, ylim, find_minimal, fd, bd, too_expensive)
+            stack.append((xmid, xlim, ymid, ylim, hi_minimal))
+            stack.append((xoff, xmid, yoff, ymid, lo_minimal))
+    return deleted, inserted
+
+def _shift_boundaries(changed, equivs):
+    """Slide each run of changes as far down as it goes, merging with later
+    runs, then back up to line up with a run in the other file (GNU diff)."""
+    for f in (0, 1):
+        ch = changed[f]
+        other = changed[1 - f]
+        eq = equivs[f]
+        i_end = len(eq)
+        # ch and other carry a 0 sentinel at each end, so index k is slot k + 1.
+        i = j = 0
+        while True:
+            while i < i_end and not ch[i + 1]:
+                while other[j + 1]:
+                    j += 1
+                j += 1
+                i += 1
+            if i == i_end:
+                break
+            start = i
+            i += 1
+            while ch[i + 1]:
+                i += 1
+            while other[j + 1]:
+                j += 1
+            while True:
+                runlength = i - start
+                while start and eq[start - 1] == eq[i - 1]:
+                    start -= 1
+                    ch[start + 1] = 1
+                    i -= 1
+                    ch[i + 1] = 0
+                    while ch[start]:
+                        start -= 1
+                    j -= 1
+                    while other[j + 1]:
+                        j -= 1
+                corresponding = i if other[j] else i_end
+                while i != i_end and eq[start] == eq[i]:
+                    ch[start + 1] = 0
+                    start += 1
+                    ch[i + 1] = 1
+                    i += 1
+                    while ch[i + 1]:
+                        i += 1
+                    j += 1
+                    while other[j + 1]:
+                        j += 1
+                        corresponding = i
+                if runlength == i - start:
+                    break
+            while corresponding < i:
+                start -= 1
+                ch[start + 1] = 1
+                i -= 1
+                ch[i + 1] = 0
+                j -= 1
+                while other[j + 1]:
+                    j -= 1
+
+def gnu_diff_changes(old_lines, new_lines, horizon):
+    """Return GNU diff's change list as (old_start, old_end, new_start, new_end)."""
+    buffers = []
+    missing = []
+    for lines in (old_lines, new_lines):
+        miss = bool(lines) and not lines[-1].endswith(b"\n")
+        buffers.append(b"".join(lines) + (b"\n" if miss else b""))
+        missing.append(miss)
+    prefix_end, suffix0, suffix1 = _identical_ends(buffers[0], buffers[1], missing[0], missing[1], horizon)
+    prefix = buffers[0].count(b"\n", 0, prefix_end)
+    region = (old_lines[prefix:buffers[0].count(b"\n", 0, suffix0)],
+              new_lines[prefix:buffers[1].count(b"\n", 0, suffix1)])
+
+    ids = {}
+    equivs = [[ids.setdefault(line, len(ids) + 1) for line in lines] for lines in region]
+    discarded = _discard_confusing_lines(equivs)
+    changed = []
+    kept = []
+    for eq, discards in zip(equivs, discarded):
+        changed.append([0] + [1 if d else 0 for d in discards] + [0])
+        kept.append([k for k, d in enumerate(discards) if not d])
+    diags = len(kept[0]) + len(kept[1]) + 3
+    too_expensive = 1
+    while diags:
+        diags >>= 2
+        too_expensive <<= 1
+    deleted, inserted = _compareseq(
+        [equivs[0][k] for k in kept[0]], [equivs[1][k] for k in kept[1]], max(4096, too_expensive))
+    for k in deleted:
+        changed[0][kept[0][k] + 1] = 1
+    for k in inserted:
+        changed[1][kept[1][k] + 1] = 1
+    _shift_boundaries(changed, equivs)
+
+    changes = []
+    ch0, ch1 = changed
+    len0, len1 = len(equivs[0]), len(equivs[1])
+    i0 = i1 = 0
+    while i0 < len0 or i1 < len1:
+        if ch0[i0 + 1] or ch1[i1 + 1]:
+            start0, start1 = i0, i1
+            while ch0[i0 + 1]:
+                i0 += 1
+            while ch1[i1 + 1]:
+                i1 += 1
+            changes.append((prefix + start0, prefix + i0, prefix + start1, prefix + i1))
+        i0 += 1
+        i1 += 1
+    return changes
+
+def _format_range(start, length):
+    beginning = start + 1
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+def unified_diff_lines(old_lines, new_lines, old_label, new_label, context=DIFF_CONTEXT_LINES):
+    changes = gnu_diff_changes(old_lines, new_lines, context)
+    if not changes:
+        return []
+
+    # Like GNU diff, changes separated by at most 2 * context lines share a hunk.
+    groups = [[changes[0]]]
+    for change in changes[1:]:
+        if change[0] - groups[-1][-1][1] > 2 * context:
+            groups.append([change])
+        else:
+            groups[-1].append(change)
+
+    out = [f"--- {old_label}", f"+++ {new_label}"]
+
+    def emit(tag, lines, start, end):
+        out.extend(tag + line.rstrip(b"\n").decode("utf-8", errors="replace") for line in lines[start:end])
+        # GNU diff flags a last line that has no newline right after it.
+        if start < end == len(lines) and not lines[-1].endswith(b"\n"):
+            out.append("\\ No newline at end of file")
+
+    for group in groups:
+        i1 = max(0, group[0][0] - context)
+        j1 = max(0, group[0][2] - context)
+        i2 = min(len(old_lines), group[-1][1] + context)
+        j2 = min(len(new_lines), group[-1][3] + context)
+        out.append(f"@@ -{_format_range(i1, i2 - i1)} +{_format_range(j1, j2 - j1)} @@")
+        i = i1
+        for ci1, ci2, cj1, cj2 in group:
+            emit(" ", old_lines, i, ci1)
+            emit("-", old_lines, ci1, ci2)
+            emit("+", new_lines, cj1, cj2)
+            i = ci2
+        emit(" ", old_lines, i, i2)
+    return out
+
+def _builtin_capture(old_file, new_file, old_data=None, new_data=None):
+    try:
+        if old_data is None:
+            old_data = Path(old_file).read_bytes()
+        if new_data is None:
+            new_data = Path(new_file).read_bytes()
+    except OSError as e:
+        return None, [f"[ERROR] Failed to read files for diff: {e}"], None
+    if not (is_text_content(old_file, old_data) and is_text_content(new_file, new_data)):
+        text = f"Binary files {old_file} and {new_file} differ\n"
+        return text, text.splitlines(), None
+    lines = unified_diff_lines(_split_lines(old_data), _split_lines(new_data), old_file, new_file)
+    if not lines:
+        return None, [], None
+    # Re-split like the diffoscope path so stray \r and friends break lines
+    # the same way in both engines.
+    text = "\n".join(lines) + "\n"
+    return text, text.splitlines(), None
+
+BUILTIN_DIFF_VERSION = "builtin-3"
+# Bumped when diffoscope output captured through DiffoscopeLibrary changes,
+# so cached diffs from an older worker are not reused.
+DIFFOSCOPE_CACHE_REVISION = 2
+
+def resolve_diff_engine(old_file, new_file, engine, data=None):
+    if engine != "auto":
+        return engine
+    if data is not None:
+        text = is_text_content(old_file, data[0][:8192]) and is_text_content(new_file, data[1][:8192])
+        return "builtin" if text else "diffoscope"
+    try:
+        with open(old_file, "rb") as f1, open(new_file, "rb") as f2:
+            if is_text_content(old_file, f1.read(8192)) and is_text_content(new_file, f2.read(8192)):
+                return "builtin"
+    except OSError:
+        pass
+    return "diffoscope"
+
+def diff_capture(old_file, new_file, engine="diffoscope", diffoscope_format="text", data=None):
+    # `data` is an optional (old_bytes, new_bytes) pair for content that is
+    # not on disk, such as archive members; the paths are then only labels.
+    if resolve_diff_engine(old_file, new_file, engine, data) == "builtin":
+        return _builtin_capture(old_file, new_file, *(data or ()))
+    if data is not None:
+        return _diffoscope_capture_data(old_file, new_file, data, diffoscope_format)
+    return _diffoscope_capture(old_file, new_file, diffoscope_format)
+
+def _diffoscope_capture_data(old_label, new_label, data, output_format="text"):
+    # diffoscope needs real files: write both sides under a scratch
+    # directory, keeping their names, and put the labels back afterwards.
+    with tempfile.TemporaryDirectory(prefix="diffsbom-") as tmp:
+        old_file = os.path.join(tmp, "a", os.path.basename(str(old_label)))
+        new_file = os.path.join(tmp, "b", os.path.basename(str(new_label)))
+        for path, content in ((old_file, data[0]), (new_file, data[1])):
+            os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(content)
+        text, lines, _ = _diffoscope_capture(old_file, new_file, output_format)
+    if text is None:
+        return text, lines, None
+    text = text.replace(old_file, str(old_label)).replace(new_file, str(new_label))
+    return text, text.splitlines(), None
+
+@lru_cache(maxsize=None)
+def diff_engine_version(engine):
+    if engine == "builtin":
+        return BUILTIN_DIFF_VERSION
+    if shutil.which("diffoscope") is None:
+        return None
+    stdout, _, rc = run_command_capture(["diffoscope", "--version"], timeout=60)
+    if rc != 0 or not stdout.strip():
+        return None
+    return f"{stdout.strip()}/{DIFFOSCOPE_CACHE_REVISION}"
+
+class DiffCache:
+    MAX_BYTES = 512 << 20
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        cache_dir = cache_dir or default_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "diffs.sqlite3")
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS diffs ("
+            " key TEXT PRIMARY KEY, body BLOB, size INTEGER, last_used INTEGER)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS diffs_lru ON diffs(last_used)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(old_hash, new_hash, engine, version):
+        return hashlib.sha256(f"{old_hash}\0{new_hash}\0{engine}\0{version}".encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT body FROM diffs WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE diffs SET last_used = ? WHERE key = ?", (time.time_ns(), key))
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key, text):
+        body = zlib.compress(text.encode("utf-8"))
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO diffs VALUES (?, ?, ?, ?)",
+                    (key, body, len(body), time.time_ns()),
+                )
+            self._evict()
+
+    def _evict(self):
+        (total,) = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM diffs").fetchone()
+        if total <= self.max_bytes:
+            return
+        with self.conn:
+            for key, size in self.conn.execute("SELECT key, size FROM diffs ORDER BY last_used").fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM diffs WHERE key = ?", (key,))
+                total -= size
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM diffs")
+
+    def close(self):
+        self.conn.close()
+
+def cached_diff_capture(old_file, new_file, engine="diffoscope", diff_cache=None, old_hash=None, new_hash=None,
+                        diffoscope_format="text", data=None):
+    if diff_cache is None or old_hash is None or new_hash is None:
+        return diff_capture(old_file, new_file, engine, diffoscope_format, data)
+    engine = resolve_diff_engine(old_file, new_file, engine, data)
+    version = diff_engine_version(engine)
+    if version is None:
+        return diff_capture(old_file, new_file, engine, diffoscope_format, data)
+
+    # Diffs are stored without their ---/+++ header so the same blob pair
+    # can be reused under any path.
+    header = f"--- {old_file}\n+++ {new_file}\n"
+    variant = f"{engine}-{diffoscope_format}" if engine == "diffoscope" else engine
+    key = DiffCache.make_key(old_hash, new_hash, variant, version)
+    body = diff_cache.get(key)
+    if body is not None:
+        text = header + body
+        return text, text.splitlines(), None
+
+    text, lines, records = diff_capture(old_file, new_file, engine, diffoscope_format, data)
+    if text is not None and text.startswith(header):
+        diff_cache.put(key, text[len(header):])
+    return text, lines, records
+
+def _diff_entry(old_path, new_path, diff_engine="diffoscope", diff_cache=None, digests=(None, None),
+                diffoscope_format="text", functions=False, data=None):
+    start = time.perf_counter()
+    text, lines, records = cached_diff_capture(old_path, new_path, diff_engine, diff_cache, *digests,
+                                               diffoscope_format, data)
+    TRACER.record_file(new_path, diff_engine, time.perf_counter() - start, len(text or ""),
+                       error=bool(lines) and lines[0].startswith("[ERROR]"))
+    entry = {"file": str(new_path), "change": lines}
+    if functions and function_language(new_path) is not None and lines:
+        # The new file's own content lets hunks without section text find
+        # the function they start in.
+        sources = {str(new_path): data[1] if data is not None else new_path}
+        if records is not None:
+            entry["functions"] = function_changes_from_records(records, sources)
+        else:
+            entry["functions"] = analyze_function_changes(lines, sources)
+    return text, entry
+
+def default_jobs():
+    return os.cpu_count() or 1
+
+def thread_pool(max_workers):
+    # In serve mode the workers print into the same job response as the
+    # thread that created the pool (see _JobStdout).
+    if isinstance(sys.stdout, _JobStdout):
+        return ThreadPoolExecutor(max_workers=max_workers, initializer=sys.stdout.adopt,
+                                  initargs=(sys.stdout.buffer_of_caller(),))
+    return ThreadPoolExecutor(max_workers=max_workers)
 
 def _parse_dir_diff_output(stdout: str):
     sections = {"added": [], "removed": [], "modified": []}
@@ -69,15 +1075,427 @@ def _parse_dir_diff_output(stdout: str):
             sections[state].append(line.strip())
     return sections
 
-def compare_directories(old_dir, new_dir, diff_script="./filediff.sh", filter_source=True):
+HASH_CHUNK_SIZE = 1 << 20
+HASH_MMAP_THRESHOLD = 16 << 20
+HASH_BATCH_FILES = 1024
+
+class DiffPhaseCancelled(Exception):
+    pass
+
+# generate_sbom_with_diff sets `event` on the thread running the diff
+# phase; the tree walk and hashing poll it so a failed scan stops them too.
+_DIFF_PHASE = threading.local()
+
+def check_diff_phase():
+    event = getattr(_DIFF_PHASE, "event", None)
+    if event is not None and event.is_set():
+        raise DiffPhaseCancelled()
+
+IgnoreRule = namedtuple("IgnoreRule", "text pattern regex negate dir_only anchored")
+
+def _gitignore_regex(pattern, anchored):
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == "/"):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("/**", i) and i + 3 == len(pattern):
+            out.append("/.*")
+            i += 3
+            continue
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[" and "]" in pattern[i + 2:]:
+            j = pattern.index("]", i + 2)
+            body = pattern[i + 1:j].replace("\\", "\\\\")
+            out.append("[" + ("^" + body[1:] if body.startswith("!") else body) + "]")
+            i = j
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return re.compile(("" if anchored else "(?:.*/)?") + "".join(out) + r"\Z")
+
+def parse_ignore_lines(lines):
+    """Parse gitignore syntax: comments, `!` negation, trailing `/`, `*`, `?`, `[...]` and `**`."""
+    rules = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        text = line
+        stripped = line.rstrip(" ")
+        if stripped.endswith("\\") and len(stripped) < len(line):
+            stripped += " "
+        line = stripped
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        elif line.startswith(("\\!", "\\#")):
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+        anchored = "/" in line
+        line = line.lstrip("/")
+        rules.append(IgnoreRule(text, line, _gitignore_regex(line, anchored), negate, dir_only, anchored))
+    return rules
+
+def read_ignore_file(path):
+    try:
+        with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+            return parse_ignore_lines(f)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return []
+
+def _match_rules(layers, rel, is_dir):
+    # Last matching rule wins, as in git; None when no rule matches.
+    result = None
+    for base, rules in layers:
+        if not rel.startswith(base):
+            continue
+        sub = rel[len(base):]
+        for rule in rules:
+            if (is_dir or not rule.dir_only) and rule.regex.match(sub):
+                result = not rule.negate
+    return result
+
+class IgnoreRules:
+    """Paths a tree walk leaves out: .gitignore files, --exclude-from and --include-from.
+
+    Rules use gitignore syntax. The exclude file applies from the tree root
+    with the lowest precedence, then each directory's .gitignore (with
+    --gitignore), deeper files overriding shallower ones. A path matching
+    the include file is kept regardless. As in git, nothing below an
+    excluded directory is kept, and the directory is not descended, unless
+    an include rule names a path inside it (e.g. `vendor/mylib/`).
+    """
+    def __init__(self, gitignore=False, exclude_from=None, include_from=None):
+        self.gitignore = gitignore
+        self.exclude_from = exclude_from
+        self.include_from = include_from
+        self.exclude = read_ignore_file(exclude_from) if exclude_from else []
+        self.include = read_ignore_file(include_from) if include_from else []
+        self._gitignore_files = {}
+
+    def base_layers(self):
+        return [("", self.exclude)] if self.exclude else []
+
+    def excluded(self, layers, rel, is_dir, inherited=False):
+        if not inherited and not _match_rules(layers, rel, is_dir):
+            return False
+        return not _match_rules([("", self.include)], rel, is_dir)
+
+    def reaches_into(self, rel_dir):
+        # Whether an include rule could match something below rel_dir.
+        # Unanchored rules match at any depth, so they are not consulted.
+        prefix = rel_dir + "/"
+        for rule in self.include:
+            if rule.negate or not rule.anchored:
+                continue
+            literal = re.split(r"[*?\[\\]", rule.pattern, 1)[0]
+            if literal.startswith(prefix) or prefix.startswith(literal):
+                return True
+        return False
+
+    def path_excluded(self, rel, root=None):
+        """excluded() for one path, checking its parent directories as a walk would.
+
+        With a root, .gitignore files along the path are read (once per
+        directory) from that tree; without one only the user rules apply.
+        """
+        layers = self.base_layers()
+        parts = rel.split("/")
+        excluded = False
+        for depth in range(len(parts)):
+            prefix = "/".join(parts[:depth]) + "/" if depth else ""
+            if root is not None and self.gitignore:
+                key = (str(root), prefix)
+                if key not in self._gitignore_files:
+                    self._gitignore_files[key] = read_ignore_file(os.path.join(root, prefix, ".gitignore"))
+                if self._gitignore_files[key]:
+                    layers = layers + [(prefix, self._gitignore_files[key])]
+            sub = "/".join(parts[:depth + 1])
+            is_dir = depth < len(parts) - 1
+            excluded = self.excluded(layers, sub, is_dir, excluded)
+            if is_dir and excluded and not self.reaches_into(sub):
+                return True
+        return excluded
+
+    def describe(self, reports=None):
+        info = {"gitignore": self.gitignore}
+        if self.exclude_from:
+            info["exclude_from"] = str(Path(self.exclude_from).resolve())
+            info["exclude"] = [rule.text for rule in self.exclude]
+        if self.include_from:
+            info["include_from"] = str(Path(self.include_from).resolve())
+            info["include"] = [rule.text for rule in self.include]
+        for side, report in (reports or {}).items():
+            info[side] = report
+        return info
+
+def walk_tree(root, rules=None, source_only=False, report=None):
+    # With rules, excluded directories are pruned before they are read and
+    # excluded files are never stat()ed; `report` collects the .gitignore
+    # rules that applied and the pruned directories. source_only skips
+    # files is_source_file() would drop later anyway.
+    index = {}
+    stack = [(str(root), "", rules.base_layers() if rules is not None else [], False)]
+    while stack:
+        check_diff_phase()
+        path, prefix, layers, inherited = stack.pop()
+        if rules is not None and rules.gitignore:
+            local = read_ignore_file(os.path.join(path, ".gitignore"))
+            if local:
+                layers = layers + [(prefix, local)]
+                if report is not None:
+                    report.setdefault("gitignore", {})[prefix + ".gitignore"] = [rule.text for rule in local]
+        with os.scandir(path) as it:
+            for entry in it:
+                rel = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if rel == ".git":
+                        continue
+                    excluded = rules is not None and rules.excluded(layers, rel, True, inherited)
+                    if excluded and not rules.reaches_into(rel):
+                        if report is not None:
+                            report.setdefault("pruned", []).append(rel + "/")
+                        continue
+                    stack.append((entry.path, rel + "/", layers, excluded))
+                elif entry.is_file(follow_symlinks=False):
+                    if source_only and not is_source_file(rel):
+                        continue
+                    if rules is not None and rules.excluded(layers, rel, False, inherited):
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                    index[rel] = (st.st_size, st.st_mtime_ns, st.st_ino)
+    if report is not None and "pruned" in report:
+        report["pruned"].sort()
+    return index
+
+def hash_file(path, size=None):
+    if size is None:
+        size = os.path.getsize(path)
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        if size >= HASH_MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+        else:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.environ.get("DIFFSBOM_CACHE_DIR") or os.path.join(base, "diffsbom")
+
+class HashCache:
+    MAX_BYTES = 256 << 20
+    # Files touched this recently may still change within the same mtime
+    # tick, so their hashes are not remembered.
+    RACY_WINDOW_NS = 2_000_000_000
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        cache_dir = cache_dir or default_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "hashes.sqlite3")
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes ("
+            " path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER,"
+            " sha256 TEXT, last_used INTEGER)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS file_hashes_lru ON file_hashes(last_used)")
+        self.conn.commit()
+
+    def lookup(self, path, sig):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, inode, sha256 FROM file_hashes WHERE path = ?", (path,)
+            ).fetchone()
+        if row is None or tuple(row[:3]) != tuple(sig):
+            return None
+        return row[3]
+
+    def touch(self, paths):
+        now = time.time_ns()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE file_hashes SET last_used = ? WHERE path = ?",
+                [(now, p) for p in paths],
+            )
+
+    def store(self, entries):
+        now = time.time_ns()
+        rows = [
+            (path, sig[0], sig[1], sig[2], sha, now)
+            for path, sig, sha in entries
+            if sig[1] < now - self.RACY_WINDOW_NS
+        ]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?)", rows
+                )
+            self.evict()
+
+    def _used_bytes(self):
+        # Pages in use, so rows freed by eviction stop counting even though
+        # SQLite keeps the file at its high-water mark.
+        (pages,) = self.conn.execute("PRAGMA page_count").fetchone()
+        (free,) = self.conn.execute("PRAGMA freelist_count").fetchone()
+        (page_size,) = self.conn.execute("PRAGMA page_size").fetchone()
+        return (pages - free) * page_size
+
+    def evict(self):
+        with self.lock:
+            used = self._used_bytes()
+            if used <= self.max_bytes:
+                return
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM file_hashes").fetchone()
+            # Rows are of similar size; drop the least recently used share
+            # that brings the database to 90% of the limit.
+            excess = count - int(count * self.max_bytes * 0.9 / used)
+            with self.conn:
+                self.conn.execute(
+                    "DELETE FROM file_hashes WHERE path IN ("
+                    " SELECT path FROM file_hashes ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM file_hashes")
+
+    def close(self):
+        self.conn.close()
+
+def hash_files(files, jobs=None, hash_cache=None):
+    hashes = {}
+    misses = []
+    for path, sig in files:
+        if path in hashes:
+            continue
+        sha = hash_cache.lookup(path, sig) if hash_cache is not None else None
+        if sha is None:
+            misses.append((path, sig))
+        hashes[path] = sha
+    if hash_cache is not None:
+        hash_cache.touch([p for p, sha in hashes.items() if sha is not None])
+
+    if misses:
+        computed = []
+        try:
+            with thread_pool(jobs or default_jobs()) as pool:
+                for start in range(0, len(misses), HASH_BATCH_FILES):
+                    check_diff_phase()
+                    batch = misses[start:start + HASH_BATCH_FILES]
+                    results = pool.map(lambda item: hash_file(item[0], item[1][0]), batch)
+                    for (path, sig), sha in zip(batch, results):
+                        hashes[path] = sha
+                        computed.append((path, sig, sha))
+        finally:
+            if hash_cache is not None:
+                hash_cache.store(computed)
+    return hashes
+
+def diff_trees(old_dir, new_dir, jobs=None, hash_cache=None, rules=None, source_only=False):
     old_dir = Path(old_dir).resolve()
     new_dir = Path(new_dir).resolve()
+    reports = {"old": {}, "new": {}}
+    old_index = walk_tree(old_dir, rules, source_only, reports["old"])
+    new_index = walk_tree(new_dir, rules, source_only, reports["new"])
+
+    added = sorted(set(new_index) - set(old_index))
+    removed = sorted(set(old_index) - set(new_index))
+    modified = []
+    candidates = []
+    for rel in sorted(set(old_index) & set(new_index)):
+        if old_index[rel][0] != new_index[rel][0]:
+            modified.append(rel)
+        else:
+            candidates.append(rel)
+
+    files = [(str(old_dir / rel), old_index[rel]) for rel in candidates]
+    files += [(str(new_dir / rel), new_index[rel]) for rel in candidates]
+    hashes = hash_files(files, jobs=jobs, hash_cache=hash_cache)
+    pair_hashes = {}
+    for rel in candidates:
+        old_hash, new_hash = hashes[str(old_dir / rel)], hashes[str(new_dir / rel)]
+        if old_hash != new_hash:
+            modified.append(rel)
+            pair_hashes[rel] = (old_hash, new_hash)
 
+    parts = {"added": added, "removed": removed, "modified": sorted(modified), "hashes": pair_hashes}
+    if rules is not None:
+        parts["ignored"] = reports
+    return parts
+
+def tree_index(root, jobs=None, hash_cache=None, rules=None, source_only=False, report=None):
+    root = Path(root).resolve()
+    index = walk_tree(root, rules, source_only, report)
+    hashes = hash_files([(str(root / rel), sig) for rel, sig in index.items()], jobs=jobs, hash_cache=hash_cache)
+    return {rel: hashes[str(root / rel)] for rel in index}
+
+def diff_indexes(old_index, new_index):
+    # Same result as diff_trees, but from two fully hashed trees, so any
+    # pair of versions whose indexes are known can be compared for free.
+    added = sorted(set(new_index) - set(old_index))
+    removed = sorted(set(old_index) - set(new_index))
+    pair_hashes = {
+        rel: (old_index[rel], new_index[rel])
+        for rel in set(old_index) & set(new_index)
+        if old_index[rel] != new_index[rel]
+    }
+    return {"added": added, "removed": removed, "modified": sorted(pair_hashes), "hashes": pair_hashes}
+
+def tree_fingerprint(root, jobs=None, hash_cache=None):
+    root = Path(root).resolve()
+    if root.is_file():
+        return "F" + hash_file(root)
+
+    index = walk_tree(root)
+    hashes = hash_files([(str(root / rel), sig) for rel, sig in index.items()], jobs=jobs, hash_cache=hash_cache)
+
+    # Merkle-style: every directory digest covers the names and digests of
+    # its children, so the root digest changes iff any file or path does.
+    children = {"": {}}
+    for rel in index:
+        parent, _, name = rel.rpartition("/")
+        children.setdefault(parent, {})[name] = "F" + hashes[str(root / rel)]
+        while parent:
+            parent, _, name = parent.rpartition("/")
+            children.setdefault(parent, {}).setdefault(name, None)
+    for directory in sorted(children, key=lambda d: d.count("/") + bool(d), reverse=True):
+        h = hashlib.sha256()
+        for name, digest in sorted(children[directory].items()):
+            h.update(f"{name}\0{digest}\n".encode("utf-8", errors="surrogateescape"))
+        digest = "D" + h.hexdigest()
+        if directory:
+            parent, _, name = directory.rpartition("/")
+            children[parent][name] = digest
+        else:
+            return digest
+
+def _run_dir_diff_script(old_dir, new_dir, diff_script):
     if not Path(diff_script).exists():
         raise FileNotFoundError(f"diff script not found: {diff_script}")
     if not os.access(diff_script, os.X_OK):
         raise PermissionError(f"diff script is not executable: {diff_script}")
 
+    TRACER.count_subprocess(diff_script)
     proc = subprocess.run(
         [diff_script, str(old_dir), str(new_dir)],
         stdout=subprocess.PIPE,
@@ -89,17 +1507,134 @@ def compare_directories(old_dir, new_dir, diff_script="./filediff.sh", filter_so
         raise RuntimeError(
             f"dir diff script failed (rc={proc.returncode}).\nSTDERR:\n{proc.stderr}"
         )
+    return _parse_dir_diff_output(proc.stdout)
+
+def _stat_signature(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+RENAME_LIMIT = 10000
+RENAME_MAX_BYTES = 1 << 20
+
+def _line_profile(path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read(RENAME_MAX_BYTES + 1)
+    except OSError:
+        return None
+    if len(data) > RENAME_MAX_BYTES:
+        return None
+    return Counter(data.splitlines())
+
+def _similarity(a, b):
+    # Share of lines in common, as a percentage of both files together.
+    # Modelled on git's rename score, which counts bytes rather than lines.
+    total = sum(a.values()) + sum(b.values())
+    return 100 if total == 0 else 200 * sum((a & b).values()) // total
+
+def detect_renames(old_dir, new_dir, added, removed, jobs=None, hash_cache=None, similarity=None,
+                   limit=RENAME_LIMIT):
+    """Pair removed files with added ones that have the same or similar content.
+
+    Exact moves are a join on size and then content hash, so only files
+    with a same-sized counterpart are hashed and nothing is diffed. With
+    `similarity` (a percentage), the remaining files are compared by line
+    profile: all same-extension pairs if there are at most `limit` of them,
+    otherwise only pairs with the same file name. Returns the exact pairs,
+    the near pairs with their score, and the still unmatched added and
+    removed paths.
+    """
+    sizes = {}
+    for rel in removed:
+        sizes.setdefault(os.path.getsize(old_dir / rel), []).append(rel)
+    new_candidates = [rel for rel in added if os.path.getsize(new_dir / rel) in sizes]
+    old_candidates = sorted({old for rel in new_candidates for old in sizes[os.path.getsize(new_dir / rel)]})
+    files = [(str(old_dir / rel), _stat_signature(old_dir / rel)) for rel in old_candidates]
+    files += [(str(new_dir / rel), _stat_signature(new_dir / rel)) for rel in new_candidates]
+    hashes = hash_files(files, jobs=jobs, hash_cache=hash_cache)
 
-    parts = _parse_dir_diff_output(proc.stdout)
+    by_hash = {}
+    for rel in old_candidates:
+        by_hash.setdefault(hashes[str(old_dir / rel)], []).append(rel)
+    exact = []
+    for rel in sorted(new_candidates):
+        sources = by_hash.get(hashes[str(new_dir / rel)])
+        if sources:
+            exact.append((sources.pop(0), rel))
+    matched_old = {old for old, _ in exact}
+    matched_new = {new for _, new in exact}
+    added = [rel for rel in added if rel not in matched_new]
+    removed = [rel for rel in removed if rel not in matched_old]
 
-    def _maybe_filter(paths):
-        if not filter_source:
-            return paths
-        return [p for p in paths if is_source_file(p)]
+    near = []
+    if similarity is not None and added and removed:
+        def key(rel):
+            return os.path.splitext(rel)[1] if len(added) * len(removed) <= limit else os.path.basename(rel)
+        groups = {}
+        for rel in removed:
+            groups.setdefault(key(rel), ([], []))[0].append(rel)
+        for rel in added:
+            groups.setdefault(key(rel), ([], []))[1].append(rel)
+        profiles = {}
 
-    added_rel = _maybe_filter(parts["added"])
-    removed_rel = _maybe_filter(parts["removed"])
-    modified_rel = _maybe_filter(parts["modified"])
+        def profile(path):
+            if path not in profiles:
+                profiles[path] = _line_profile(path)
+            return profiles[path]
+
+        scored = []
+        budget = limit
+        for olds, news in groups.values():
+            for old in olds:
+                for new in news:
+                    if budget <= 0:
+                        break
+                    budget -= 1
+                    a, b = profile(old_dir / old), profile(new_dir / new)
+                    if a is not None and b is not None:
+                        score = _similarity(a, b)
+                        if score >= similarity:
+                            scored.append((-score, old, new))
+        used_old, used_new = set(), set()
+        for score, old, new in sorted(scored):
+            if old not in used_old and new not in used_new:
+                used_old.add(old)
+                used_new.add(new)
+                near.append((old, new, -score))
+        added = [rel for rel in added if rel not in used_new]
+        removed = [rel for rel in removed if rel not in used_old]
+    return exact, near, added, removed
+
+def compare_directories(old_dir, new_dir, diff_script=None, filter_source=True, jobs=None, hash_cache=None,
+                        diff_engine="diffoscope", diff_cache=None, stream=False, diffoscope_format="text",
+                        functions=False, diff_output="diff_output.txt", parts=None, renames=False,
+                        rename_similarity=None, rename_limit=RENAME_LIMIT, budget=None, ignore=None):
+    old_dir = Path(old_dir).resolve()
+    new_dir = Path(new_dir).resolve()
+
+    if parts is None:
+        with TRACER.phase("tree_diff"):
+            if diff_script:
+                parts = _run_dir_diff_script(old_dir, new_dir, diff_script)
+            else:
+                parts = diff_trees(old_dir, new_dir, jobs=jobs, hash_cache=hash_cache, rules=ignore,
+                                   source_only=filter_source)
+
+    def _maybe_filter(paths, root=None):
+        if filter_source:
+            paths = [p for p in paths if is_source_file(p)]
+        if ignore is not None and "ignored" not in parts:
+            # A diff script walks the trees itself, so its paths are
+            # filtered afterwards.
+            paths = [p for p in paths if not ignore.path_excluded(p, root)]
+        return paths
+
+    added_rel = _maybe_filter(parts["added"], new_dir)
+    removed_rel = _maybe_filter(parts["removed"], old_dir)
+    modified_rel = _maybe_filter(parts["modified"], new_dir)
+    if renames or rename_similarity is not None:
+        exact, near, added_rel, removed_rel = detect_renames(old_dir, new_dir, added_rel, removed_rel, jobs,
+                                                             hash_cache, rename_similarity, rename_limit)
 
     changes = {
         "old_version": str(old_dir),
@@ -107,19 +1642,593 @@ def compare_directories(old_dir, new_dir, diff_script="./filediff.sh", filter_so
         "Deleted file": sorted([str((old_dir / rel).resolve()) for rel in removed_rel]),
         "Modified file": []
     }
+    if ignore is not None:
+        changes["ignore_rules"] = ignore.describe(parts.get("ignored"))
+    if renames or rename_similarity is not None:
+        # Exact moves need no diff; near renames are diffed like modified
+        # files, old path against new path.
+        renamed = [{"file": str((new_dir / new).resolve()), "old_file": str((old_dir / old).resolve()),
+                    "similarity": 100} for old, new in exact]
+        if budget is not None:
+            budget.charge(dict(changes, **{"Renamed file": renamed}))
+            for old, _, score in near:
+                budget.charge_fields({"old_file": str((old_dir / old).resolve()), "similarity": score})
+        if near:
+            near_pairs = [((old_dir / old).resolve(), (new_dir / new).resolve()) for old, new, _ in near]
+            near_hashes = [(None, None)] * len(near_pairs)
+            if diff_cache is not None:
+                hashes = hash_files([(str(p), _stat_signature(p)) for pair in near_pairs for p in pair],
+                                    jobs=jobs, hash_cache=hash_cache)
+                near_hashes = [(hashes[str(old)], hashes[str(new)]) for old, new in near_pairs]
+            near_entries = _iter_modified_entries(near_pairs, near_hashes,
+                                                  max(1, min(jobs or default_jobs(), len(near_pairs))),
+                                                  diff_engine, diff_cache, diffoscope_format, functions,
+                                                  diff_output, budget=budget, names=[new for _, new, _ in near])
+            for (old_path, _), (_, _, score), entry in zip(near_pairs, near, near_entries):
+                renamed.append({"file": entry["file"], "old_file": str(old_path), "similarity": score,
+                                **{k: v for k, v in entry.items() if k != "file"}})
+        changes["Renamed file"] = sorted(renamed, key=lambda e: e["file"])
+        changes["Modified file"] = changes.pop("Modified file")
+    elif budget is not None:
+        budget.charge(changes)
+
+    modified_rel = sorted(modified_rel)
+    pairs = [((old_dir / rel).resolve(), (new_dir / rel).resolve()) for rel in modified_rel]
+    workers = max(1, min(jobs or default_jobs(), len(pairs) or 1))
+
+    pair_hashes = [(None, None)] * len(pairs)
+    if diff_cache is not None:
+        known = parts.get("hashes", {})
+        missing = [p for rel, pair in zip(modified_rel, pairs) if rel not in known for p in pair]
+        hashes = hash_files([(str(p), _stat_signature(p)) for p in missing], jobs=jobs, hash_cache=hash_cache)
+        pair_hashes = [
+            known.get(rel) or (hashes[str(old_path)], hashes[str(new_path)])
+            for rel, (old_path, new_path) in zip(modified_rel, pairs)
+        ]
+
+    changes["Modified file"] = _iter_modified_entries(pairs, pair_hashes, workers, diff_engine, diff_cache,
+                                                      diffoscope_format, functions, diff_output, budget=budget,
+                                                      names=modified_rel)
+    if budget is not None:
+        changes["budget"] = budget.summary
+    if not stream:
+        changes["Modified file"] = list(changes["Modified file"])
+
+    return {"upgrade": {"file_changes": changes}}
+
+def bounded_map(pool, fn, *iterables, window):
+    # Like Executor.map, but keeps at most `window` calls in flight so a
+    # slow consumer bounds how many results sit in memory. Calls that have
+    # not started are cancelled if the consumer stops early.
+    pending = deque()
+    try:
+        for args in zip(*iterables):
+            pending.append(pool.submit(fn, *args))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+LOW_PRIORITY_RE = re.compile(
+    r"(^|/)(vendor|third_party|thirdparty|3rdparty|node_modules|external|extern|deps)/"
+    r"|(\.pb\.(go|cc|h)|_pb2\.py|\.min\.js)$|generated|amalgamation",
+    re.IGNORECASE,
+)
+
+def diff_priority(path, size):
+    # Vendored and generated files last, then smallest first: the most
+    # useful diffs for the least time come before any budget runs out.
+    return bool(LOW_PRIORITY_RE.search(str(path))), size
+
+class DiffBudget:
+    """Limits on the diff phase: --time-budget, --max-file-bytes, --max-upgrade-bytes.
+
+    The clock starts when the budget is created. Files are checked just
+    before they are diffed; entries are admitted in scheduling order and
+    the one that crosses the upgrade size cap is truncated to fit. The cap
+    covers the whole upgrade section as write_json_stream writes it: the
+    fixed parts are charged up front and room for a skip marker is held
+    back for every file not yet admitted.
+    `summary` is recorded in file_changes as "budget".
+    """
+    # Nesting depth of a file entry in the written SBOM:
+    # sbom > upgrade > file_changes > "Modified file" > entry.
+    LEVEL = 4
+    SKIP_REASONS = ("time budget exhausted", "upgrade size cap reached")
+
+    def __init__(self, time_budget=None, max_file_bytes=None, max_upgrade_bytes=None):
+        self.max_file_bytes = max_file_bytes
+        self.max_upgrade_bytes = max_upgrade_bytes
+        self.deadline = time.monotonic() + time_budget if time_budget is not None else None
+        self.used = 0
+        self.reserved = 0
+        self.full = False
+        self.summary = {k: v for k, v in (("time_budget", time_budget), ("max_file_bytes", max_file_bytes),
+                                          ("max_upgrade_bytes", max_upgrade_bytes)) if v is not None}
+        self.summary.update(skipped=0, truncated=0)
+
+    @staticmethod
+    def _size(obj, level, key=None):
+        # UTF-8 bytes write_json_stream spends on obj as an item at `level`,
+        # the separator and indentation in front of it included.
+        text = json.dumps(obj, indent=2, ensure_ascii=False)
+        size = len(text.encode("utf-8", errors="surrogateescape")) + text.count("\n") * 2 * level + 2 + 2 * level
+        if key is not None:
+            size += len(json.dumps(key, ensure_ascii=False).encode("utf-8")) + 2
+        return size
+
+    def _marker(self, path):
+        reason = max(self.SKIP_REASONS + (f"file larger than {self.max_file_bytes} bytes",), key=len)
+        return self._size({"file": path, "change": [], "skipped": reason}, self.LEVEL)
+
+    def charge(self, changes):
+        """Count everything in file_changes but the file entries themselves."""
+        if self.max_upgrade_bytes is None:
+            return
+        # The skipped/truncated counts are only known at the end.
+        summary = dict(self.summary, skipped=10 ** 9, truncated=10 ** 9)
+        shell = dict(changes, **{"Modified file": [], "budget": summary})
+        self.used += self._size({"upgrade": {"file_changes": shell}}, 0) + 64
+
+    def charge_fields(self, fields):
+        """Count fields added to an entry after it was admitted."""
+        if self.max_upgrade_bytes is not None:
+            self.used += sum(self._size(v, self.LEVEL + 1, k) for k, v in fields.items())
+
+    def reserve(self, paths):
+        """Hold back room for a skip marker for each of `paths`."""
+        if self.max_upgrade_bytes is not None:
+            self.reserved += sum(self._marker(str(p)) for p in paths)
+
+    def skip_reason(self, size):
+        if self.max_file_bytes is not None and size > self.max_file_bytes:
+            return f"file larger than {self.max_file_bytes} bytes"
+        if self.full:
+            return "upgrade size cap reached"
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            return "time budget exhausted"
+        return None
+
+    def admit(self, entry, path=None):
+        """Admit the entry diffed for `path`, releasing its reserved marker."""
+        if self.max_upgrade_bytes is not None:
+            if not self.full and self.used + self.reserved > self.max_upgrade_bytes:
+                print(f"[WARN] The file lists and skip markers alone take {self.used + self.reserved} bytes; "
+                      f"--max-upgrade-bytes={self.max_upgrade_bytes} cannot be met")
+                self.full = True
+            self.reserved -= self._marker(str(path if path is not None else entry["file"]))
+        if "skipped" in entry:
+            self.summary["skipped"] += 1
+            if self.max_upgrade_bytes is not None:
+                self.used += self._size(entry, self.LEVEL)
+            return entry
+        if self.max_upgrade_bytes is None:
+            return entry
+        size = self._size(entry, self.LEVEL)
+        room = self.max_upgrade_bytes - self.used - self.reserved
+        if size <= room:
+            self.used += size
+            return entry
+        self.full = True
+        lines = entry.get("change") or []
+        base = dict({k: v for k, v in entry.items() if k != "change"}, truncated=True, omitted_lines=len(lines))
+        room -= self._size(dict(base, change=[]), self.LEVEL)
+        kept = 0
+        for line in lines:
+            room -= self._size(line, self.LEVEL + 2)
+            if room < 0:
+                break
+            kept += 1
+        if kept == len(lines):
+            kept -= 1
+        # Cut at a hunk boundary so a truncated entry is still a valid diff.
+        hunks = [i for i, line in enumerate(lines[:kept + 1]) if NESTED_HUNK_RE.match(line)]
+        if hunks:
+            kept = hunks[-1] if hunks[-1] > hunks[0] else 0
+        if kept <= 0:
+            self.summary["skipped"] += 1
+            entry = {"file": entry["file"], "change": [], "skipped": "upgrade size cap reached"}
+        else:
+            self.summary["truncated"] += 1
+            entry = dict(entry, change=lines[:kept], truncated=True, omitted_lines=len(lines) - kept)
+        self.used += self._size(entry, self.LEVEL)
+        return entry
+
+def _pair_size(pair):
+    try:
+        return max(os.path.getsize(pair[0]), os.path.getsize(pair[1]))
+    except OSError:
+        return 0
+
+def _iter_modified_entries(pairs, pair_hashes, workers, diff_engine, diff_cache, diffoscope_format="text",
+                           functions=False, diff_output="diff_output.txt", contents=None, budget=None,
+                           sizes=None, names=None):
+    # Results come back in submission order, so "Modified file" and
+    # diff_output.txt are identical to a serial run regardless of which
+    # worker finishes first. The report is written through one buffered
+    # handle for the whole run.
+    #
+    # `contents` optionally holds one loader per pair returning (old, new)
+    # bytes for content that is not on disk. With a budget, pairs are
+    # diffed in diff_priority order and the entries are put back in path
+    # order once all of them are in. `names` are the paths used for
+    # diff_priority when the pair paths are absolute.
+    loaders = contents if contents is not None else [None] * len(pairs)
+    if budget is not None and sizes is None:
+        sizes = [None if load is not None else _pair_size(pair) for pair, load in zip(pairs, loaders)]
+    if sizes is None:
+        sizes = [None] * len(pairs)
+
+    def diff_one(pair, digests, load, size):
+        data = None
+        if budget is not None:
+            reason = budget.skip_reason(size or 0)
+            if reason is None and size is None and load is not None:
+                data = load()
+                reason = budget.skip_reason(max(len(data[0]), len(data[1])))
+            if reason is not None:
+                return None, {"file": str(pair[1]), "change": [], "skipped": reason}
+        if data is None and load is not None:
+            data = load()
+        return _diff_entry(*pair, diff_engine, diff_cache, digests, diffoscope_format, functions, data)
+
+    order = list(range(len(pairs)))
+    if budget is not None:
+        budget.reserve(new for _, new in pairs)
+        names = names or [new for _, new in pairs]
+        order.sort(key=lambda i: diff_priority(names[i], sizes[i] or 0))
+    out = None
+    try:
+        with thread_pool(workers) as pool:
+            results = bounded_map(
+                pool, diff_one,
+                [pairs[i] for i in order], [pair_hashes[i] for i in order],
+                [loaders[i] for i in order], [sizes[i] for i in order],
+                window=workers * 2,
+            )
+            admitted = {}
+            for i, (text, entry) in zip(order, results):
+                if budget is not None:
+                    # A file the size cap turns away stays out of diff_output.txt too.
+                    entry = admitted[i] = budget.admit(entry, pairs[i][1])
+                if text is not None and "skipped" not in entry:
+                    if out is None:
+                        out = open(diff_output, "a", encoding="utf-8", errors="replace", buffering=1 << 20)
+                    _write_diff_output(out, text)
+                if budget is None:
+                    yield entry
+            for i in sorted(admitted):
+                yield admitted[i]
+    finally:
+        if out is not None:
+            out.close()
+
+ARCHIVE_INPUT_SUFFIXES = (".tar.gz", ".tgz", ".tar.xz", ".txz", ".tar.bz2", ".tbz2", ".tar", ".zip")
+
+def is_archive_input(path):
+    return str(path).lower().endswith(ARCHIVE_INPUT_SUFFIXES) and os.path.isfile(path)
+
+def iter_archive_members(path):
+    """Yield (name, file object) for each regular file, streaming the archive once.
+
+    Tarballs are read as a stream, so compressed members are decompressed
+    exactly once and never written to disk. Symlinks and other special
+    members are skipped, as the tree walk skips them.
+    """
+    if str(path).lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    with zf.open(info) as f:
+                        yield info.filename, f
+        return
+    with tarfile.open(path, "r|*") as tf:
+        for member in tf:
+            if member.isreg():
+                yield member.name, tf.extractfile(member)
+
+def _archive_root(names):
+    # Release archives usually wrap everything in one "project-1.2.3/"
+    # directory; like diffing the extracted top-level directories, paths
+    # are matched below it.
+    tops = {name.split("/", 1)[0] for name in names}
+    if len(tops) == 1 and all("/" in name for name in names):
+        return tops.pop() + "/"
+    return ""
+
+def scan_archive(path, want=None, keep=None):
+    """Hash every member in one pass; buffer the bytes of selected members.
+
+    `want(name)` decides before reading whether a member's bytes may be
+    needed, `keep(name, sha)` after hashing whether to hold on to them, so
+    only changed members stay in memory. Returns ({name: (size, sha)},
+    {name: bytes}).
+    """
+    index, data = {}, {}
+    for name, f in iter_archive_members(path):
+        name = name[2:] if name.startswith("./") else name
+        h = hashlib.sha256()
+        chunks = [] if want is not None and want(name) else None
+        size = 0
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+            size += len(chunk)
+            if chunks is not None:
+                chunks.append(chunk)
+        sha = h.hexdigest()
+        index[name] = (size, sha)
+        if chunks is not None and (keep is None or keep(name, sha)):
+            data[name] = b"".join(chunks)
+        else:
+            data.pop(name, None)
+    return index, data
+
+def _fetch_members(path, names, data):
+    missing = set(names) - set(data)
+    if not missing:
+        return
+    for name, f in iter_archive_members(path):
+        name = name[2:] if name.startswith("./") else name
+        if name in missing:
+            data[name] = f.read()
+            missing.discard(name)
+            if not missing:
+                break
+
+def compare_archives(old_archive, new_archive, filter_source=True, jobs=None, diff_engine="diffoscope",
+                     diff_cache=None, stream=False, diffoscope_format="text", functions=False,
+                     diff_output="diff_output.txt", budget=None, ignore=None):
+    """compare_directories for two release archives, without extracting them.
+
+    The old archive is hashed in one streaming pass. The new one is hashed
+    in one pass too, buffering only members whose content differs from the
+    old member of the same path. A last pass over the old archive fetches
+    just the bytes of those changed members. Reported paths are the member
+    names inside each archive. Of the ignore rules only the exclude and
+    include files apply, matched against paths below the archive root.
+    """
+    def selected(rel):
+        return (not (rel == ".git" or rel.startswith(".git/")) and (not filter_source or is_source_file(rel))
+                and (ignore is None or not ignore.path_excluded(rel)))
+
+    with TRACER.phase("tree_diff"):
+        old_index, _ = scan_archive(old_archive)
+        old_root = _archive_root(old_index)
+        old_names = {name[len(old_root):]: name for name in old_index}
+
+        # The new archive's root is only known once it has been read, so
+        # buffering guesses it from the first member; a wrong guess just
+        # costs another pass in _fetch_members.
+        guess = []
+
+        def rel_of(name):
+            if not guess:
+                guess.append(name.split("/", 1)[0] + "/" if "/" in name else "")
+            return name[len(guess[0]):] if name.startswith(guess[0]) else name
+
+        def want(name):
+            rel = rel_of(name)
+            return rel in old_names and selected(rel)
+
+        def keep(name, sha):
+            return old_index[old_names[rel_of(name)]][1] != sha
+
+        new_index, new_data = scan_archive(new_archive, want, keep)
+        new_root = _archive_root(new_index)
+        new_names = {name[len(new_root):]: name for name in new_index}
+
+    added = sorted(rel for rel in set(new_names) - set(old_names) if selected(rel))
+    removed = sorted(rel for rel in set(old_names) - set(new_names) if selected(rel))
+    modified = sorted(
+        rel for rel in set(old_names) & set(new_names)
+        if selected(rel) and old_index[old_names[rel]][1] != new_index[new_names[rel]][1]
+    )
+    changes = {
+        "old_version": str(Path(old_archive).resolve()),
+        "New file": [new_names[rel] for rel in added],
+        "Deleted file": [old_names[rel] for rel in removed],
+        "Modified file": [],
+    }
+    if ignore is not None:
+        changes["ignore_rules"] = ignore.describe()
+    if budget is not None:
+        budget.charge(changes)
+
+    old_data = {}
+    _fetch_members(old_archive, [old_names[rel] for rel in modified], old_data)
+    _fetch_members(new_archive, [new_names[rel] for rel in modified], new_data)
+    pairs = [(old_names[rel], new_names[rel]) for rel in modified]
+    pair_hashes = [(old_index[old][1], new_index[new][1]) for old, new in pairs]
+    # Hand each member's bytes to the diff exactly once and drop them
+    # afterwards, so memory shrinks as the diffs progress.
+    contents = [lambda old=old, new=new: (old_data.pop(old), new_data.pop(new)) for old, new in pairs]
+    sizes = [max(old_index[old][0], new_index[new][0]) for old, new in pairs]
+    workers = max(1, min(jobs or default_jobs(), len(pairs) or 1))
+    changes["Modified file"] = _iter_modified_entries(pairs, pair_hashes, workers, diff_engine, diff_cache,
+                                                      diffoscope_format, functions, diff_output, contents,
+                                                      budget, sizes)
+    if budget is not None:
+        changes["budget"] = budget.summary
+    if not stream:
+        changes["Modified file"] = list(changes["Modified file"])
+    return {"upgrade": {"file_changes": changes}}
+
+def git_output(repo, *args):
+    TRACER.count_subprocess("git")
+    proc = subprocess.run(["git", "-C", str(repo), *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(f"git {' '.join(args)} failed: {proc.stderr.decode('utf-8', 'replace').strip()}")
+    return proc.stdout
+
+class GitBlobReader:
+    """Read blobs through one long-lived `git cat-file --batch` process."""
+    def __init__(self, repo):
+        TRACER.count_subprocess("git")
+        self.proc = subprocess.Popen(["git", "-C", str(repo), "cat-file", "--batch"],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+
+    def read(self, blob_id):
+        with self.lock:
+            self.proc.stdin.write(blob_id.encode("ascii") + b"\n")
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().split()
+            if len(header) != 3:
+                raise RuntimeError(f"git cat-file: unknown object {blob_id}")
+            data = self.proc.stdout.read(int(header[2]))
+            self.proc.stdout.read(1)
+            return data
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+def git_blob_sizes(repo, blob_ids):
+    """Sizes of blobs by id, from a single `git cat-file --batch-check`."""
+    if not blob_ids:
+        return {}
+    TRACER.count_subprocess("git")
+    proc = subprocess.run(["git", "-C", str(repo), "cat-file", "--batch-check"],
+                          input="".join(f"{blob_id}\n" for blob_id in blob_ids).encode("ascii"),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(f"git cat-file --batch-check failed: {proc.stderr.decode('utf-8', 'replace').strip()}")
+    sizes = {}
+    for line in proc.stdout.decode("ascii").splitlines():
+        fields = line.split()
+        if len(fields) == 3:
+            sizes[fields[0]] = int(fields[2])
+    return sizes
+
+GIT_FILE_MODES = ("100644", "100755")
+
+def git_tree_changes(repo, old_commit, new_commit):
+    # diff-tree compares blob ids, so unchanged files are never read.
+    out = git_output(repo, "diff-tree", "-r", "-z", "--no-renames", old_commit, new_commit)
+    fields = out.split(b"\0")
+    added, removed, modified = {}, {}, {}
+    for i in range(0, len(fields) - 1, 2):
+        old_mode, new_mode, old_id, new_id, status = fields[i].decode("ascii").lstrip(":").split()
+        path = os.fsdecode(fields[i + 1])
+        old_file, new_file = old_mode in GIT_FILE_MODES, new_mode in GIT_FILE_MODES
+        if old_file and new_file:
+            if old_id != new_id:
+                modified[path] = (old_id, new_id)
+        elif new_file:
+            added[path] = new_id
+        elif old_file:
+            removed[path] = old_id
+    return added, removed, modified
+
+def compare_git_refs(repo, old_ref, new_ref, filter_source=True, jobs=None, diff_engine="diffoscope",
+                     diff_cache=None, stream=False, diffoscope_format="text", functions=False,
+                     diff_output="diff_output.txt", renames=False, budget=None, ignore=None):
+    """compare_directories for two revisions of one local repository.
+
+    Added, removed and modified paths come from `git diff-tree`, so no
+    checkout is hashed; only the changed blobs are read, through a single
+    `git cat-file --batch` process, and diffed in memory. Blob ids double
+    as diff cache keys. Paths are relative to the repository root, and the
+    diff labels use git's <ref>:<path> notation. Of the ignore rules only
+    the exclude and include files apply.
+    """
+    old_commit = git_output(repo, "rev-parse", "--verify", f"{old_ref}^{{commit}}").decode().strip()
+    new_commit = git_output(repo, "rev-parse", "--verify", f"{new_ref}^{{commit}}").decode().strip()
+    with TRACER.phase("tree_diff"):
+        added, removed, modified = git_tree_changes(repo, old_commit, new_commit)
+
+    def selected(paths):
+        return {p: v for p, v in paths.items()
+                if (not filter_source or is_source_file(p)) and (ignore is None or not ignore.path_excluded(p))}
+
+    added, removed, modified = selected(added), selected(removed), selected(modified)
+    changes = {"old_version": old_ref}
+    if ignore is not None:
+        changes["ignore_rules"] = ignore.describe()
+    renamed = []
+    if renames:
+        by_blob = {}
+        for path in sorted(removed):
+            by_blob.setdefault(removed[path], []).append(path)
+        for path in sorted(added):
+            sources = by_blob.get(added[path])
+            if sources:
+                old_path = sources.pop(0)
+                renamed.append({"file": path, "old_file": old_path, "similarity": 100})
+                del removed[old_path], added[path]
+    changes["New file"] = sorted(added)
+    changes["Deleted file"] = sorted(removed)
+    if renames:
+        changes["Renamed file"] = renamed
+    if budget is not None:
+        budget.charge(changes)
+
+    paths = sorted(modified)
+    pairs = [(f"{old_ref}:{p}", f"{new_ref}:{p}") for p in paths]
+    pair_hashes = [modified[p] for p in paths]
+    workers = max(1, min(jobs or default_jobs(), len(pairs) or 1))
+    sizes = None
+    if budget is not None:
+        # Blob sizes let the budget skip and order files without reading them.
+        blob_sizes = git_blob_sizes(repo, sorted({blob_id for pair in pair_hashes for blob_id in pair}))
+        sizes = [max(blob_sizes.get(old_id, 0), blob_sizes.get(new_id, 0)) for old_id, new_id in pair_hashes]
+    reader = GitBlobReader(repo)
 
-    for rel in sorted(modified_rel):
-        old_path = (old_dir / rel).resolve()
-        new_path = (new_dir / rel).resolve()
-        diff_output = run_diffoscope(old_path, new_path)
-        changes["Modified file"].append({
-            "file": str(new_path),
-            "change": diff_output
-        })
+    def entries():
+        contents = [lambda old_id=old_id, new_id=new_id: (reader.read(old_id), reader.read(new_id))
+                    for old_id, new_id in pair_hashes]
+        try:
+            for path, entry in zip(paths, _iter_modified_entries(pairs, pair_hashes, workers, diff_engine,
+                                                                 diff_cache, diffoscope_format, functions,
+                                                                 diff_output, contents, budget, sizes,
+                                                                 paths)):
+                entry["file"] = path
+                yield entry
+        finally:
+            reader.close()
 
+    changes["Modified file"] = entries()
+    if budget is not None:
+        changes["budget"] = budget.summary
+    if not stream:
+        changes["Modified file"] = list(changes["Modified file"])
     return {"upgrade": {"file_changes": changes}}
 
-def compare_files(old_file, new_file):
+@contextmanager
+def git_scan_target(repo, ref):
+    """A directory holding `ref`'s files for the SBOM scanner.
+
+    The repository itself when its HEAD is already `ref` and the worktree
+    holds nothing else (no local changes, untracked or ignored files),
+    otherwise a temporary export made with `git archive` (the repository
+    is never modified).
+    """
+    commit = git_output(repo, "rev-parse", "--verify", f"{ref}^{{commit}}").decode().strip()
+    try:
+        head = git_output(repo, "rev-parse", "--verify", "HEAD").decode().strip()
+    except RuntimeError:
+        head = None
+    if head == commit and not git_output(repo, "status", "--porcelain", "--ignored").strip():
+        yield str(Path(repo).resolve())
+        return
+    with tempfile.TemporaryDirectory(prefix="diffsbom-git-") as tmp:
+        TRACER.count_subprocess("git")
+        proc = subprocess.Popen(["git", "-C", str(repo), "archive", "--format=tar", commit], stdout=subprocess.PIPE)
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tf:
+            if hasattr(tarfile, "data_filter"):
+                tf.extractall(tmp, filter="data")
+            else:
+                tf.extractall(tmp)
+        if proc.wait() != 0:
+            raise RuntimeError(f"git archive {ref} failed")
+        yield tmp
+
+def compare_files(old_file, new_file, diff_engine="diffoscope", diff_cache=None, diffoscope_format="text",
+                  functions=False, diff_output="diff_output.txt"):
     old_file = Path(old_file).resolve()
     new_file = Path(new_file).resolve()
     if not (is_source_file(str(old_file)) and is_source_file(str(new_file))):
@@ -127,19 +2236,22 @@ def compare_files(old_file, new_file):
 
     with open(old_file, 'r', errors='replace') as f1, open(new_file, 'r', errors='replace') as f2:
         if f1.read() != f2.read():
-            diff_output = run_diffoscope(old_file, new_file)
+            digests = (hash_file(old_file), hash_file(new_file)) if diff_cache is not None else (None, None)
+            text, entry = _diff_entry(old_file, new_file, diff_engine, diff_cache, digests,
+                                      diffoscope_format, functions)
+            if text is not None:
+                try:
+                    with open(diff_output, "a", encoding="utf-8", errors="replace") as f:
+                        _write_diff_output(f, text)
+                except Exception as e:
+                    entry["change"] = [f"[ERROR] Failed to run diffoscope: {e}"]
             return {
                 "upgrade": {
                     "file_changes": {
                         "old_version": str(old_file.parent),
                         "New file": [],
                         "Deleted file": [],
-                        "Modified file": [
-                            {
-                                "file": str(new_file),
-                                "change": diff_output
-                            }
-                        ]
+                        "Modified file": [entry]
                     }
                 }
             }
@@ -155,6 +2267,679 @@ def compare_files(old_file, new_file):
                 }
             }
 
+HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@(.*)$")
+COMPACT_ENCODING = "compact-v1"
+
+def parse_unified_diff(lines):
+    if len(lines) < 3 or not lines[0].startswith("--- ") or not lines[1].startswith("+++ "):
+        return None
+    hunks = []
+    for line in lines[2:]:
+        m = HUNK_HEADER_RE.match(line)
+        if m:
+            old_start, old_count, new_start, new_count, section = m.groups()
+            hunks.append([
+                int(old_start), 1 if old_count is None else int(old_count),
+                int(new_start), 1 if new_count is None else int(new_count),
+                section, [],
+            ])
+        elif hunks and line[:1] in (" ", "-", "+", "\\"):
+            hunks[-1][5].append(line)
+        else:
+            return None
+    if not hunks:
+        return None
+    return lines[0][4:], lines[1][4:], hunks
+
+def _range_index(start, count):
+    return start - 1 if count else start
+
+def _recontext(hunk, context):
+    old_start, old_count, new_start, new_count, section, body = hunk
+    old_i = _range_index(old_start, old_count)
+    new_i = _range_index(new_start, new_count)
+
+    # (old position, new position) before every body line
+    positions = []
+    runs = []
+    for n, line in enumerate(body):
+        positions.append((old_i, new_i))
+        tag = line[:1]
+        if tag == "\\":
+            # A no-newline marker belongs to the line before it.
+            if runs and runs[-1][1] == n:
+                runs[-1][1] = n + 1
+            continue
+        if tag != " ":
+            if runs and runs[-1][1] == n:
+                runs[-1][1] = n + 1
+            else:
+                runs.append([n, n + 1])
+        if tag in (" ", "-"):
+            old_i += 1
+        if tag in (" ", "+"):
+            new_i += 1
+    positions.append((old_i, new_i))
+    if not runs:
+        return [hunk]
+
+    groups = [[runs[0]]]
+    for run in runs[1:]:
+        if run[0] - groups[-1][-1][1] > 2 * context:
+            groups.append([run])
+        else:
+            groups[-1].append(run)
+
+    out = []
+    for group in groups:
+        lo = max(0, group[0][0] - context)
+        hi = min(len(body), group[-1][1] + context)
+        while hi < len(body) and body[hi][:1] == "\\":
+            hi += 1
+        (o1, n1), (o2, n2) = positions[lo], positions[hi]
+        out.append([
+            o1 + 1 if o2 > o1 else o1, o2 - o1,
+            n1 + 1 if n2 > n1 else n1, n2 - n1,
+            section if lo == 0 else "", body[lo:hi],
+        ])
+    return out
+
+def _hunk_id(text):
+    return hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).hexdigest()[:16]
+
+def compact_entry(entry, table, context=None):
+    parsed = parse_unified_diff(entry.get("change") or [])
+    if parsed is None:
+        return entry
+    old_label, new_label, hunks = parsed
+    if context is not None:
+        hunks = [h for hunk in hunks for h in _recontext(hunk, context)]
+
+    refs = []
+    for old_start, old_count, new_start, new_count, section, body in hunks:
+        text = "\n".join(body)
+        hunk_id = _hunk_id(text)
+        table.setdefault(hunk_id, text)
+        ref = [old_start, old_count, new_start, new_count, hunk_id]
+        if section:
+            ref.append(section)
+        refs.append(ref)
+
+    compact = {k: v for k, v in entry.items() if k != "change"}
+    compact["old"] = old_label
+    if new_label != entry.get("file"):
+        compact["new"] = new_label
+    compact["hunks"] = refs
+    return compact
+
+def compact_upgrade(upgrade_data, context=None):
+    # The hunk table sits after "Modified file" so that, when entries are
+    # produced lazily, it is complete by the time the writer reaches it.
+    changes = upgrade_data["upgrade"]["file_changes"]
+    if context is not None:
+        # Trimming cannot add context the engines never produced.
+        context = min(context, DIFF_CONTEXT_LINES)
+    table = {}
+    entries = changes.pop("Modified file")
+    if isinstance(entries, list):
+        changes["Modified file"] = [compact_entry(e, table, context) for e in entries]
+    else:
+        changes["Modified file"] = (compact_entry(e, table, context) for e in entries)
+    if "budget" in changes:
+        changes["budget"] = changes.pop("budget")
+    changes["encoding"] = COMPACT_ENCODING
+    if context is not None:
+        changes["context"] = context
+    changes["hunks"] = table
+    return upgrade_data
+
+def expand_entry(entry, table):
+    if "hunks" not in entry:
+        return entry
+    change = [f"--- {entry['old']}", f"+++ {entry.get('new', entry['file'])}"]
+    for ref in entry["hunks"]:
+        old_start, old_count, new_start, new_count, hunk_id = ref[:5]
+        section = ref[5] if len(ref) > 5 else ""
+        old_range = f"{old_start}" if old_count == 1 else f"{old_start},{old_count}"
+        new_range = f"{new_start}" if new_count == 1 else f"{new_start},{new_count}"
+        change.append(f"@@ -{old_range} +{new_range} @@{section}")
+        change.extend(table[hunk_id].split("\n"))
+    expanded = {k: v for k, v in entry.items() if k not in ("old", "new", "hunks")}
+    expanded["change"] = change
+    return expanded
+
+def expand_upgrade(upgrade):
+    changes = upgrade.get("file_changes")
+    if not isinstance(changes, dict) or changes.get("encoding") != COMPACT_ENCODING:
+        return upgrade
+    table = changes.get("hunks", {})
+    expanded = {k: v for k, v in changes.items() if k not in ("encoding", "context", "hunks")}
+    expanded["Modified file"] = [expand_entry(e, table) for e in changes.get("Modified file", [])]
+    upgrade["file_changes"] = expanded
+    return upgrade
+
+def load_sbom(path):
+    with open(path, "r", encoding="utf-8") as f:
+        sbom = json.load(f)
+    if isinstance(sbom.get("upgrade"), dict):
+        expand_upgrade(sbom["upgrade"])
+    return sbom
+
+JSON_TOKEN_RE = re.compile(rb'"((?:[^"\\]|\\.)*)"(\s*:)?|[\[\]{}]')
+UPGRADE_INDEX_VERSION = 1
+
+UPGRADE_PATH = (b"$", b"upgrade")
+CHANGES_PATH = UPGRADE_PATH + (b"file_changes",)
+MODIFIED_PATH = CHANGES_PATH + (b"Modified file",)
+
+def _scan_upgrade(buf, start=0, stack=None):
+    """Locate the parts of the upgrade section by byte offset.
+
+    Walks string and bracket tokens only (the regex does the byte-level
+    work), tracking the key path of each open container, and records the
+    byte span of every "Modified file" entry and compact hunk, the New and
+    Deleted file lists and the other scalar fields of file_changes. Nothing
+    else is decoded, and the scan stops once the upgrade object closes.
+    """
+    index = {"modified": {}, "new": [], "deleted": [], "hunks": {}, "fields": {}}
+    stack = list(stack or [])
+    key = None
+    entry_start = entry_file = None
+    for m in JSON_TOKEN_RE.finditer(buf, start):
+        token = m.group(0)
+        if m.group(2):
+            key = json.loads(b'"' + m.group(1) + b'"')
+            continue
+        here = tuple(stack)
+        if token == b"{" or token == b"[":
+            if here == MODIFIED_PATH:
+                entry_start, entry_file = m.start(), None
+            stack.append(key.encode("utf-8") if key is not None else (b"$" if not stack else b"[]"))
+            key = None
+            continue
+        if token == b"}" or token == b"]":
+            closed = stack.pop()
+            if not stack or (closed == b"upgrade" and stack == [b"$"]):
+                break
+            if tuple(stack) == MODIFIED_PATH and entry_file is not None:
+                index["modified"][entry_file] = [entry_start, m.end()]
+                entry_file = None
+            key = None
+            continue
+        if here == MODIFIED_PATH + (b"[]",) and key == "file":
+            entry_file = json.loads(token)
+        elif here == CHANGES_PATH + (b"New file",):
+            index["new"].append(json.loads(token))
+        elif here == CHANGES_PATH + (b"Deleted file",):
+            index["deleted"].append(json.loads(token))
+        elif here == CHANGES_PATH + (b"hunks",) and key is not None:
+            index["hunks"][key] = [m.start(), m.end()]
+        elif here == CHANGES_PATH and key is not None:
+            index["fields"][key] = json.loads(token)
+        key = None
+    else:
+        raise ValueError("unexpected end of JSON input")
+    return index
+
+class UpgradeReader:
+    """Query the upgrade section of a large SBOM without loading it.
+
+    The SBOM is memory-mapped and scanned once to build a sidecar index
+    (<sbom>.idx) mapping each modified file to the byte span of its entry.
+    Path queries are answered from the index alone; a single entry is
+    decoded from its span on demand.
+
+    The scan runs in Python, so building the index takes five to ten times
+    as long as json.load of the same file; it pays off from the second
+    query on. SBOMs smaller than INDEX_MIN_BYTES are simply loaded with
+    json.load and get no index.
+    """
+    INDEX_MIN_BYTES = 16 << 20
+
+    def __init__(self, path, rebuild=False):
+        self.path = str(path)
+        self.index_path = self.path + ".idx"
+        self.f = open(self.path, "rb")
+        self.mm = None
+        try:
+            st = os.fstat(self.f.fileno())
+            if st.st_size < self.INDEX_MIN_BYTES:
+                self.index = self._load_small()
+                return
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.index = None if rebuild else self._load_index(st)
+            if self.index is None:
+                self.index = self._build_index(st)
+        except BaseException:
+            self.close()
+            raise
+
+    def _load_small(self):
+        # Same shape as the index, with whole entries in place of spans.
+        sbom = json.loads(self.f.read().decode("utf-8"))
+        upgrade = sbom.get("upgrade") if isinstance(sbom, dict) else None
+        changes = expand_upgrade(upgrade).get("file_changes", {}) if isinstance(upgrade, dict) else {}
+        entries = changes.get("Modified file", [])
+        return {"new": changes.get("New file", []), "deleted": changes.get("Deleted file", []),
+                "modified": {e["file"]: e for e in entries if isinstance(e, dict) and "file" in e},
+                "fields": {k: v for k, v in changes.items()
+                           if k not in ("New file", "Deleted file", "Modified file")
+                           and not isinstance(v, (dict, list))}}
+
+    def _load_index(self, st):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (index.get("version"), index.get("size"), index.get("mtime_ns")) != (
+                UPGRADE_INDEX_VERSION, st.st_size, st.st_mtime_ns):
+            return None
+        return index
+
+    def _build_index(self, st):
+        # In indent=2 output only a top-level key can start a line with
+        # exactly two spaces, so the scan can jump straight to "upgrade",
+        # which the writer always puts last.
+        pos = -1
+        if self.mm[:64].lstrip().startswith(b'{\n  "'):
+            pos = self.mm.rfind(b'\n  "upgrade": ')
+        if pos != -1:
+            index = _scan_upgrade(self.mm, pos, [b"$"])
+        else:
+            index = _scan_upgrade(self.mm)
+        index.update(version=UPGRADE_INDEX_VERSION, size=st.st_size, mtime_ns=st.st_mtime_ns)
+        tmp = self.index_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(index, f, ensure_ascii=False)
+            os.replace(tmp, self.index_path)
+        except OSError as e:
+            print(f"[WARN] Could not save index '{self.index_path}': {e}")
+        return index
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def files(self, prefix=""):
+        index = self.index
+        return {
+            "New file": [p for p in index["new"] if p.startswith(prefix)],
+            "Deleted file": [p for p in index["deleted"] if p.startswith(prefix)],
+            "Modified file": sorted(p for p in index["modified"] if p.startswith(prefix)),
+        }
+
+    def _decode(self, span):
+        start, end = span
+        return json.loads(self.mm[start:end].decode("utf-8"))
+
+    def entry(self, path):
+        span = self.index["modified"].get(path)
+        if span is None or self.mm is None:
+            return span
+        entry = self._decode(span)
+        if "hunks" in entry:
+            table = {ref[4]: self._decode(self.index["hunks"][ref[4]]) for ref in entry["hunks"]}
+            entry = expand_entry(entry, table)
+        return entry
+
+    def entries(self, prefix=""):
+        for path in self.files(prefix)["Modified file"]:
+            yield self.entry(path)
+
+def sbom_format(sbom):
+    if "bomFormat" in sbom:
+        return "cdx"
+    if "spdxVersion" in sbom:
+        return "spdx"
+    return None
+
+def purl_identity(purl):
+    # pkg:type/namespace/name@version?qualifiers#subpath -> pkg:type/namespace/name
+    base = purl.split("#", 1)[0].split("?", 1)[0]
+    head, _, last = base.rpartition("/")
+    if "@" in last:
+        last = last.split("@", 1)[0]
+    return f"{head}/{last}" if head else last
+
+Component = namedtuple("Component", "identity version name purl ref")
+
+def _spdx_purl(package):
+    for ref in package.get("externalRefs", []):
+        if ref.get("referenceType") == "purl":
+            return ref.get("referenceLocator")
+    return None
+
+def iter_sbom_components(sbom):
+    if sbom_format(sbom) == "spdx":
+        for package in sbom.get("packages", []):
+            purl = _spdx_purl(package)
+            identity = purl_identity(purl) if purl else package.get("name") or package.get("SPDXID")
+            yield Component(identity, package.get("versionInfo"), package.get("name"), purl,
+                            package.get("SPDXID"))
+        return
+    stack = list(reversed(sbom.get("components", [])))
+    while stack:
+        component = stack.pop()
+        purl = component.get("purl")
+        if purl:
+            identity = purl_identity(purl)
+        else:
+            identity = "/".join(filter(None, (component.get("type"), component.get("group"),
+                                              component.get("name")))) or component.get("bom-ref")
+        yield Component(identity, component.get("version"), component.get("name"), purl,
+                        component.get("bom-ref"))
+        stack.extend(reversed(component.get("components", [])))
+
+def iter_sbom_dependencies(sbom):
+    """Yield (ref, depends_on_ref) edges of a CycloneDX or SPDX document."""
+    if sbom_format(sbom) == "spdx":
+        for rel in sbom.get("relationships", []):
+            kind = rel.get("relationshipType")
+            if kind == "DEPENDS_ON":
+                yield rel.get("spdxElementId"), rel.get("relatedSpdxElement")
+            elif kind == "DEPENDENCY_OF":
+                yield rel.get("relatedSpdxElement"), rel.get("spdxElementId")
+        return
+    for dep in sbom.get("dependencies", []):
+        for target in dep.get("dependsOn", []):
+            yield dep.get("ref"), target
+
+def _component_record(component):
+    record = {"name": component.name, "version": component.version}
+    if component.purl:
+        record["purl"] = component.purl
+    if component.ref:
+        record["bom-ref"] = component.ref
+    return record
+
+def diff_sbom_components(old_sbom, new_sbom):
+    """Component-level changes between two SBOMs, in linear time.
+
+    Components are matched on their purl without version and qualifiers
+    (or type/group/name when there is no purl), so a version bump shows up
+    as one version_changed entry rather than a removal plus an addition.
+    bom-refs and SPDXIDs only resolve dependency edges; they usually differ
+    between two scans and are never compared directly.
+    """
+    def index(sbom):
+        units, refs = {}, {}
+        for component in iter_sbom_components(sbom):
+            units.setdefault((component.identity, component.version), component)
+            if component.ref:
+                refs[component.ref] = component.identity
+        edges = {}
+        for ref, target in iter_sbom_dependencies(sbom):
+            if ref in refs and target in refs:
+                edges.setdefault(refs[ref], set()).add(refs[target])
+        return units, edges
+
+    old_units, old_edges = index(old_sbom)
+    new_units, new_edges = index(new_sbom)
+    removed = {}
+    for unit, component in old_units.items():
+        if unit not in new_units:
+            removed.setdefault(component.identity, []).append(component)
+    added = {}
+    for unit, component in new_units.items():
+        if unit not in old_units:
+            added.setdefault(component.identity, []).append(component)
+
+    version_changed = []
+    for identity in sorted(set(added) & set(removed)):
+        if len(added[identity]) == 1 and len(removed[identity]) == 1:
+            old, new = removed.pop(identity)[0], added.pop(identity)[0]
+            record = {"name": new.name, "identity": identity, "old_version": old.version,
+                      "new_version": new.version}
+            if new.purl:
+                record["purl"] = new.purl
+            version_changed.append(record)
+
+    dependency_changes = []
+    for identity in sorted(set(old_edges) | set(new_edges)):
+        before, after = old_edges.get(identity, set()), new_edges.get(identity, set())
+        if before != after:
+            dependency_changes.append({"component": identity, "added": sorted(after - before),
+                                       "removed": sorted(before - after)})
+
+    def records(groups):
+        return sorted((_component_record(c) for group in groups.values() for c in group),
+                      key=lambda r: (r["name"] or "", r["version"] or ""))
+
+    return {
+        "Added component": records(added),
+        "Removed component": records(removed),
+        "Version changed": version_changed,
+        "Dependency changes": dependency_changes,
+    }
+
+FUNCTION_PATTERNS = {
+    "python": re.compile(r"^(\s*)(?:async\s+)?def\s+([A-Za-z_]\w*)\s*\("),
+    "go": re.compile(r"^()func\s+(?:\([^)]*\)\s*)?([A-Za-z_]\w*)\s*[\[(]"),
+    "rust": re.compile(
+        r"^(\s*)(?:pub(?:\([^)]*\))?\s+)?(?:(?:const|async|unsafe|default|extern(?:\s+\"[^\"]*\")?)\s+)*"
+        r"fn\s+([A-Za-z_]\w*)"
+    ),
+    "c": re.compile(
+        r"^()(?!(?:if|else|for|while|do|switch|return|typedef|struct|union|enum|case|goto|sizeof)\b)"
+        r"[A-Za-z_][\w\s\*&:<>,~]*?\b([A-Za-z_]\w*(?:::~?[A-Za-z_]\w*)*)\s*\((?:[^;{]*$|[^;{]*\)[^;{]*\{.*$)"
+    ),
+}
+FUNCTION_LANGUAGES = {
+    ".py": "python",
+    ".go": "go",
+    ".rs": "rust",
+    ".c": "c", ".h": "c", ".cc": "c", ".cpp": "c", ".cxx": "c", ".hpp": "c", ".hxx": "c",
+}
+NESTED_OLD_RE = re.compile(r"^((?:│ )*)│   --- (.*)$")
+NESTED_NEW_RE = re.compile(r"^((?:│ )*)├── \+\+\+ (.*)$")
+NESTED_HUNK_RE = re.compile(r"^((?:│ )*)(@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@.*)$")
+
+def function_language(path):
+    return FUNCTION_LANGUAGES.get(os.path.splitext(str(path))[1].lower())
+
+class FunctionChangeTracker:
+    # Attributes the lines of one file's hunks to the enclosing function.
+    # Scopes are approximated from the text: Python by indentation, Go/C
+    # by a closing brace in column 0 and Rust by a closing brace at the
+    # fn's own indentation. A hunk starts in the function named by its @@
+    # section text; without one (diffoscope never asks for it), the new
+    # file's lines above the hunk are scanned the same way, if `source`
+    # (the new file's path or bytes) is given.
+
+    def __init__(self, path, source=None):
+        self.path = path
+        self.source = source
+        self.language = function_language(path)
+        self.pattern = FUNCTION_PATTERNS.get(self.language)
+        self.def_tags = {}
+        self.changed = set()
+        self.current = None
+        self.indent = ""
+        self.hunks = 0
+        self._scopes = None
+
+    def start_hunk(self, section="", new_start=None):
+        self.current = None
+        self.hunks += 1
+        if self.pattern is None:
+            return
+        m = self.pattern.match(section.strip()) if section else None
+        if m:
+            self.current, self.indent = m.group(2), ""
+        elif new_start is not None and self.source is not None:
+            scopes = self._scopes_of_source()
+            if 0 < new_start <= len(scopes):
+                self.current, self.indent = scopes[new_start - 1]
+
+    def _scopes_of_source(self):
+        # (function, indent) open before each line of the new file.
+        if self._scopes is None:
+            try:
+                if isinstance(self.source, bytes):
+                    data = self.source
+                else:
+                    with open(self.source, "rb") as f:
+                        data = f.read()
+            except (OSError, ValueError):
+                data = b""
+            walker = FunctionChangeTracker(self.path)
+            self._scopes = []
+            for text in data.decode("utf-8", errors="replace").split("\n"):
+                self._scopes.append((walker.current, walker.indent))
+                walker.feed(" ", text.rstrip("\r"))
+        return self._scopes
+
+    def feed(self, tag, text):
+        if self.pattern is None:
+            return
+        m = self.pattern.match(text)
+        if m:
+            self.current, self.indent = m.group(2), m.group(1)
+            self.def_tags.setdefault(self.current, set()).add(tag)
+            if self.language != "python" and "{" in text and text.count("{") == text.count("}"):
+                # A one-line definition: its scope ends on the same line.
+                if tag != " ":
+                    self.changed.add(self.current)
+                self.current = None
+                return
+        elif self.current is not None and self._leaves_scope(text):
+            if tag != " ":
+                self.changed.add(self.current)
+            self.current = None
+            return
+        if tag != " " and self.current is not None:
+            self.changed.add(self.current)
+
+    def _leaves_scope(self, text):
+        if self.language == "python":
+            stripped = text.strip()
+            if not stripped or stripped.startswith(("#", "@", ")")):
+                return False
+            return len(text) - len(text.lstrip()) <= len(self.indent)
+        if self.language == "rust":
+            return text.rstrip() == self.indent + "}"
+        return text.startswith("}")
+
+    def result(self):
+        added, removed, modified = set(), set(), set()
+        for name in self.changed | set(self.def_tags):
+            tags = self.def_tags.get(name, set())
+            if tags == {"+"}:
+                added.add(name)
+            elif tags == {"-"}:
+                removed.add(name)
+            elif name in self.changed:
+                modified.add(name)
+        return {"added": sorted(added), "removed": sorted(removed), "modified": sorted(modified)}
+
+def iter_function_changes(lines, sources=None):
+    # Single pass over diff text (plain unified diffs or diffoscope's nested
+    # report); yields (new path, {"added", "removed", "modified"}) per file
+    # with hunks. `sources` maps new paths to FunctionChangeTracker sources.
+    sources = sources or {}
+    tracker = None
+    pending_old = None
+    prefix = None
+    old_left = new_left = 0
+    for line in lines:
+        line = line.rstrip("\n")
+        if old_left > 0 or new_left > 0:
+            if line.startswith(prefix):
+                body = line[len(prefix):]
+                tag = body[:1]
+                if tag in (" ", "-", "+", "\\") or body == "":
+                    if tag != "\\":
+                        if tag != "+":
+                            old_left -= 1
+                        if tag != "-":
+                            new_left -= 1
+                        if tracker is not None:
+                            tracker.feed(tag or " ", body[1:])
+                    continue
+            old_left = new_left = 0
+
+        m = HUNK_HEADER_RE.match(line)
+        nested = None if m else NESTED_HUNK_RE.match(line)
+        if m or nested:
+            prefix = nested.group(1) if nested else ""
+            m = m or HUNK_HEADER_RE.match(nested.group(2))
+            old_left = 1 if m.group(2) is None else int(m.group(2))
+            new_left = 1 if m.group(4) is None else int(m.group(4))
+            if tracker is not None:
+                tracker.start_hunk(m.group(5), int(m.group(3)))
+            continue
+
+        if line.startswith("--- "):
+            pending_old = line[4:]
+            continue
+        nested = NESTED_OLD_RE.match(line)
+        if nested:
+            pending_old = nested.group(2)
+            continue
+        new_path = None
+        if line.startswith("+++ ") and pending_old is not None:
+            new_path = line[4:]
+        else:
+            nested = NESTED_NEW_RE.match(line)
+            if nested and pending_old is not None:
+                new_path = nested.group(2)
+        if new_path is not None:
+            # Files diffoscope finds identical despite different names get
+            # headers but no hunks, and no entry.
+            if tracker is not None and tracker.pattern is not None and tracker.hunks:
+                yield tracker.path, tracker.result()
+            tracker = FunctionChangeTracker(new_path, sources.get(new_path))
+            pending_old = None
+    if tracker is not None and tracker.pattern is not None and tracker.hunks:
+        yield tracker.path, tracker.result()
+
+def analyze_function_changes(change, sources=None):
+    result = {"added": [], "removed": [], "modified": []}
+    for _, functions in iter_function_changes(change, sources):
+        for kind, names in functions.items():
+            result[kind].extend(n for n in names if n not in result[kind])
+    return {kind: sorted(names) for kind, names in result.items()}
+
+def function_changes_from_records(records, sources=None):
+    result = {"added": set(), "removed": set(), "modified": set()}
+    for record in records:
+        tracker = FunctionChangeTracker(record.source2, (sources or {}).get(record.source2))
+        if tracker.pattern is None:
+            continue
+        for header, hunk_lines in record.hunks:
+            m = HUNK_HEADER_RE.match(header)
+            tracker.start_hunk(m.group(5) if m else "", int(m.group(3)) if m else None)
+            for line in hunk_lines:
+                if line[:1] != "\\":
+                    tracker.feed(line[:1] or " ", line[1:])
+        for kind, names in tracker.result().items():
+            result[kind].update(names)
+    return {kind: sorted(names) for kind, names in result.items()}
+
+def annotate_functions(upgrade_data):
+    changes = upgrade_data["upgrade"]["file_changes"]
+
+    def annotate(entry):
+        if function_language(entry["file"]) is not None and entry.get("change"):
+            entry["functions"] = analyze_function_changes(entry["change"])
+        return entry
+
+    entries = changes["Modified file"]
+    if isinstance(entries, list):
+        changes["Modified file"] = [annotate(e) for e in entries]
+    else:
+        changes["Modified file"] = (annotate(e) for e in entries)
+    return upgrade_data
+
 def build_sbom_command(tool, fmt, target_path):
     if tool == "syft":
         if fmt == "cdx":
@@ -178,17 +2963,139 @@ def build_sbom_command(tool, fmt, target_path):
         print("[ERROR] Unknown tool. Use 'syft' or 'trivy'")
         sys.exit(1)
 
-def generate_sbom_with_upgrade(fmt, target_path, upgrade_data, tool):
-    sbom_file = os.path.join(os.getcwd(), f"sbom.{fmt}_with_upgrade.json")
+def write_json_stream(f, obj, indent=2, level=0):
+    # Produces the same text as json.dump(obj, f, indent=indent,
+    # ensure_ascii=False), but consumes generators and iterators lazily so
+    # large lists (e.g. "Modified file") never have to be materialized.
+    if isinstance(obj, dict):
+        items = iter(obj.items())
+        opener, closer = "{", "}"
+    elif isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        items = None
+    elif isinstance(obj, (list, tuple)) or hasattr(obj, "__iter__"):
+        items = iter(obj)
+        opener, closer = "[", "]"
+    else:
+        items = None
+    if items is None:
+        text = json.dumps(obj, indent=indent, ensure_ascii=False)
+        f.write(text.replace("\n", "\n" + " " * (indent * level)))
+        return
+
+    inner = "\n" + " " * (indent * (level + 1))
+    first = True
+    for item in items:
+        f.write((opener if first else ",") + inner)
+        first = False
+        if opener == "{":
+            key, item = item
+            f.write(json.dumps(str(key), ensure_ascii=False) + ": ")
+        write_json_stream(f, item, indent, level + 1)
+    if first:
+        f.write(opener + closer)
+    else:
+        f.write("\n" + " " * (indent * level) + closer)
+
+UUID_RE = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+@lru_cache(maxsize=None)
+def sbom_tool_version(tool):
+    cmd = [tool, "version"] if tool == "syft" else [tool, "--version"]
+    stdout, _, rc = run_command_capture(cmd, timeout=60)
+    if rc != 0 or not stdout.strip():
+        return None
+    return stdout.strip()
 
-    cmd = build_sbom_command(tool, fmt, target_path)
-    stdout, stderr, rc = run_command_capture(cmd, timeout=600)
+def refresh_volatile_fields(sbom):
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    if "bomFormat" in sbom:
+        if "serialNumber" in sbom:
+            sbom["serialNumber"] = f"urn:uuid:{uuid.uuid4()}"
+        if isinstance(sbom.get("metadata"), dict) and "timestamp" in sbom["metadata"]:
+            sbom["metadata"]["timestamp"] = now
+    elif "spdxVersion" in sbom:
+        if isinstance(sbom.get("creationInfo"), dict) and "created" in sbom["creationInfo"]:
+            sbom["creationInfo"]["created"] = now
+        if "documentNamespace" in sbom:
+            namespace, n = UUID_RE.subn(str(uuid.uuid4()), sbom["documentNamespace"])
+            sbom["documentNamespace"] = namespace if n else f"{namespace}-{uuid.uuid4()}"
+    return sbom
+
+class SbomCache:
+    MAX_BYTES = 256 << 20
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.dir = os.path.join(cache_dir or default_cache_dir(), "sboms")
+        os.makedirs(self.dir, exist_ok=True)
+        self.max_bytes = max_bytes or self.MAX_BYTES
+
+    def key(self, target_path, tool, fmt, jobs=None, hash_cache=None):
+        version = sbom_tool_version(tool)
+        if version is None:
+            return None
+        fingerprint = tree_fingerprint(target_path, jobs=jobs, hash_cache=hash_cache)
+        # Scanners name the document after the path they were given, so the
+        # same tree scanned under another path needs its own entry.
+        path = os.fspath(target_path)
+        return hashlib.sha256(f"{fingerprint}\0{path}\0{tool}\0{version}\0{fmt}".encode(
+            "utf-8", errors="surrogateescape")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dir, f"{key}.json.gz")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                sbom = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return refresh_volatile_fields(sbom)
+
+    def put(self, key, sbom):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                json.dump(sbom, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[WARN] Failed to cache SBOM: {e}")
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.dir):
+            if entry.name.endswith(".json.gz"):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.dir):
+            if entry.name.endswith(".json.gz"):
+                os.remove(entry.path)
+
+def parse_sbom_output(stdout, stderr, rc, tool):
     if rc != 0:
         print(f"[ERROR] SBOM generation failed with {tool}. rc={rc}\nSTDERR:\n{stderr}")
         sys.exit(1)
 
     try:
-        sbom = json.loads(stdout)
+        return json.loads(stdout)
     except json.JSONDecodeError as e:
         head = stdout.strip()[:200]
         print("[ERROR] Failed to parse SBOM JSON. "
@@ -196,38 +3103,449 @@ def generate_sbom_with_upgrade(fmt, target_path, upgrade_data, tool):
               f"First 200 chars: {head}\nDetail: {e}")
         sys.exit(1)
 
+def write_sbom_with_upgrade(fmt, sbom, upgrade_data, output=None):
+    sbom_file = output or os.path.join(os.getcwd(), f"sbom.{fmt}_with_upgrade.json")
+
+    # The upgrade section may still be producing diffs; it is streamed into
+    # a temporary file after the SBOM body so only one diff is held at a
+    # time, and the output appears atomically once complete.
     sbom["upgrade"] = upgrade_data["upgrade"]
+    tmp_file = sbom_file + ".tmp"
     try:
-        with open(sbom_file, "w", encoding="utf-8") as f:
-            json.dump(sbom, f, indent=2, ensure_ascii=False)
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            write_json_stream(f, sbom, indent=2)
+        os.replace(tmp_file, sbom_file)
         print(f"[INFO] Saved: {sbom_file}")
     except Exception as e:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
         print(f"[ERROR] Failed to write SBOM file: {e}")
         sys.exit(1)
 
-def main():
-    if len(sys.argv) < 6:
-        print("Usage:\n"
-              "  DiffSBOM.py user <cdx|spdx> <old_path> <new_path> <syft|trivy>\n"
-              "  DiffSBOM.py diff <cdx|spdx> <old_path> <new_path> <syft|trivy>")
+def _sbom_cache_key(sbom_cache, target_path, tool, fmt, jobs=None, hash_cache=None):
+    try:
+        return sbom_cache.key(target_path, tool, fmt, jobs=jobs, hash_cache=hash_cache)
+    except OSError as e:
+        print(f"[WARN] Could not fingerprint {target_path}; SBOM cache skipped: {e}")
+        return None
+
+def generate_sbom_with_upgrade(fmt, target_path, upgrade_data, tool, sbom_cache=None, hash_cache=None, output=None):
+    key = _sbom_cache_key(sbom_cache, target_path, tool, fmt, hash_cache=hash_cache) if sbom_cache else None
+    sbom = sbom_cache.get(key) if key else None
+    if sbom is not None:
+        print(f"[INFO] Reusing cached {tool} SBOM for {target_path}")
+    else:
+        cmd = build_sbom_command(tool, fmt, target_path)
+        with TRACER.phase("scan", tool=tool):
+            stdout, stderr, rc = run_command_capture(cmd, timeout=600)
+        sbom = parse_sbom_output(stdout, stderr, rc, tool)
+        if key:
+            sbom_cache.put(key, sbom)
+    with TRACER.phase("write"):
+        write_sbom_with_upgrade(fmt, sbom, upgrade_data, output)
+
+class SbomScan:
+    def __init__(self, tool, fmt, target_path, timeout=600):
+        self.tool = tool
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout
+        self.stdout = tempfile.TemporaryFile()
+        self.stderr = tempfile.TemporaryFile()
+        self.started = time.perf_counter()
+        self.traced = False
+        TRACER.count_subprocess(tool)
+        try:
+            self.proc = subprocess.Popen(
+                build_sbom_command(tool, fmt, target_path),
+                stdout=self.stdout,
+                stderr=self.stderr,
+            )
+            self.error = None
+        except Exception as e:
+            self.proc = None
+            self.error = str(e)
+
+    def poll(self):
+        if self.proc is None:
+            return 1
+        rc = self.proc.poll()
+        if rc is None and time.monotonic() > self.deadline:
+            self.kill()
+            self.error = f"Command '{self.proc.args}' timed out after {self.timeout} seconds"
+            return 1
+        if rc is not None:
+            self._trace(rc)
+        return rc
+
+    def _trace(self, rc, killed=False):
+        if not self.traced:
+            self.traced = True
+            TRACER.record_phase("scan", time.perf_counter() - self.started, tool=self.tool, rc=rc, killed=killed)
+
+    def failed(self):
+        rc = self.poll()
+        return rc is not None and (rc != 0 or self.error is not None)
+
+    def wait(self):
+        while self.poll() is None:
+            time.sleep(0.05)
+
+    def kill(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+            self._trace(self.proc.returncode, killed=True)
+
+    def result(self):
+        self.wait()
+        rc = 1 if self.error is not None else self.proc.returncode
+        self.stdout.seek(0)
+        self.stderr.seek(0)
+        stdout = self.stdout.read().decode("utf-8", errors="replace")
+        stderr = self.error or self.stderr.read().decode("utf-8", errors="replace")
+        self.stdout.close()
+        self.stderr.close()
+        return parse_sbom_output(stdout, stderr, rc, self.tool)
+
+def _iter_spooled(spool):
+    spool.seek(0)
+    for line in spool:
+        yield json.loads(line)
+
+def generate_sbom_with_diff(fmt, target_path, tool, compare, sbom_cache=None, hash_cache=None, jobs=None,
+                            output=None):
+    # The scanner and the diff pipeline are independent until the final
+    # merge, so the scanner starts first and diffs are spooled to a
+    # temporary file while it runs. A failure on either side stops the other.
+    # The target tree is fingerprinted before the scanner starts, so an SBOM
+    # cache hit never launches syft/trivy; the file hashes it stores in the
+    # hash cache are then reused by the diff phase.
+    key = _sbom_cache_key(sbom_cache, target_path, tool, fmt, jobs, hash_cache) if sbom_cache is not None else None
+    cached = sbom_cache.get(key) if key else None
+    if cached is not None:
+        print(f"[INFO] Reusing cached {tool} SBOM for {target_path}")
+    scan = SbomScan(tool, fmt, target_path) if cached is None else None
+    scan_failed = threading.Event()
+    spool = tempfile.TemporaryFile("w+", encoding="utf-8")
+
+    def diff_phase():
+        _DIFF_PHASE.event = scan_failed
+        try:
+            with TRACER.phase("compare"):
+                upgrade = compare()
+                changes = upgrade["upgrade"]["file_changes"]
+                entries = changes["Modified file"]
+                if isinstance(entries, list):
+                    return upgrade
+                try:
+                    for entry in entries:
+                        if scan_failed.is_set():
+                            return None
+                        spool.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                finally:
+                    entries.close()
+                changes["Modified file"] = _iter_spooled(spool)
+                return upgrade
+        except DiffPhaseCancelled:
+            return None
+        finally:
+            _DIFF_PHASE.event = None
+
+    try:
+        with thread_pool(1) as pool:
+            future = pool.submit(diff_phase)
+            while not wait([future], timeout=0.1).done:
+                if scan is not None and scan.failed():
+                    scan_failed.set()
+            try:
+                upgrade = future.result()
+            except BaseException:
+                if scan is not None:
+                    scan.kill()
+                raise
+        if cached is not None:
+            sbom = cached
+        else:
+            sbom = scan.result()
+            if key:
+                sbom_cache.put(key, sbom)
+        with TRACER.phase("write"):
+            write_sbom_with_upgrade(fmt, sbom, upgrade, output)
+        return sbom
+    finally:
+        spool.close()
+
+def split_options(argv):
+    positional, options = [], {}
+    for arg in argv:
+        if arg.startswith("--"):
+            key, sep, value = arg[2:].partition("=")
+            options[key] = value if sep else True
+        else:
+            positional.append(arg)
+    return positional, options
+
+def int_option(options, name, default=None):
+    value = options.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        print(f"[ERROR] --{name} expects an integer, got: {value}")
+        sys.exit(1)
+
+# Set to a dict by serve mode, so a cache opened by one job stays open for
+# the jobs after it instead of being reopened cold each time.
+WARM_CACHES = None
+WARM_CACHES_LOCK = threading.Lock()
+
+def _warm_cache(kind, options, size_option, factory):
+    if WARM_CACHES is None:
+        return factory()
+    key = (kind, options.get("cache-dir") or default_cache_dir(), options.get(size_option))
+    with WARM_CACHES_LOCK:
+        if key not in WARM_CACHES:
+            WARM_CACHES[key] = factory()
+        return WARM_CACHES[key]
+
+def open_hash_cache(options):
+    if options.get("no-cache"):
+        return None
+    try:
+        cache = _warm_cache("hash", options, "hash-cache-bytes",
+                            lambda: HashCache(options.get("cache-dir"), int_option(options, "hash-cache-bytes")))
+    except (OSError, sqlite3.Error) as e:
+        print(f"[WARN] Hash cache unavailable, hashing from scratch: {e}")
+        return None
+    if options.get("clear-cache"):
+        cache.clear()
+    return cache
+
+def open_diff_cache(options):
+    if options.get("no-cache"):
+        return None
+    try:
+        cache = _warm_cache("diff", options, "diff-cache-bytes",
+                            lambda: DiffCache(options.get("cache-dir"), int_option(options, "diff-cache-bytes")))
+    except (OSError, sqlite3.Error) as e:
+        print(f"[WARN] Diff cache unavailable, diffing from scratch: {e}")
+        return None
+    if options.get("clear-cache"):
+        cache.clear()
+    return cache
+
+def open_sbom_cache(options):
+    if options.get("no-cache"):
+        return None
+    try:
+        cache = _warm_cache("sbom", options, "sbom-cache-bytes",
+                            lambda: SbomCache(options.get("cache-dir"), int_option(options, "sbom-cache-bytes")))
+    except OSError as e:
+        print(f"[WARN] SBOM cache unavailable, scanning from scratch: {e}")
+        return None
+    if options.get("clear-cache"):
+        cache.clear()
+    return cache
+
+def configure_diffoscope_library(options):
+    global DIFFOSCOPE_LIBRARY
+    if options.get("diffoscope-lib"):
+        DIFFOSCOPE_LIBRARY = DiffoscopeLibrary()
+
+def configure_tracing(options):
+    trace = options.get("trace")
+    hooks = [load_metrics_hook(options["metrics-hook"])] if options.get("metrics-hook") else []
+    slowest = int_option(options, "slowest")
+    if not (trace or hooks or slowest is not None):
+        return
+    path = "trace.jsonl" if trace is True else trace
+    try:
+        TRACER.configure(path, hooks, 10 if slowest is None else slowest)
+    except OSError as e:
+        print(f"[ERROR] Could not open trace file '{path}': {e}")
+        sys.exit(1)
+
+def print_function_index(diff_path):
+    try:
+        with open(diff_path, "r", encoding="utf-8", errors="replace") as f:
+            index = dict(iter_function_changes(f))
+    except OSError as e:
+        print(f"[ERROR] Failed to read diff output '{diff_path}': {e}")
+        sys.exit(1)
+    json.dump(index, sys.stdout, indent=2, ensure_ascii=False)
+    sys.stdout.write("\n")
+
+def expand_sbom_file(sbom_path, output_path=None):
+    try:
+        sbom = load_sbom(sbom_path)
+    except Exception as e:
+        print(f"[ERROR] Failed to read SBOM file '{sbom_path}': {e}")
+        sys.exit(1)
+    output_path = output_path or sbom_path
+    tmp_file = output_path + ".tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(sbom, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_file, output_path)
+        print(f"[INFO] Saved: {output_path}")
+    except Exception as e:
+        print(f"[ERROR] Failed to write SBOM file: {e}")
+        sys.exit(1)
+
+def query_sbom(sbom_path, prefix, options):
+    try:
+        reader = UpgradeReader(sbom_path, rebuild=bool(options.get("rebuild-index")))
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] Failed to read SBOM file '{sbom_path}': {e}")
+        sys.exit(1)
+    with reader:
+        if options.get("file"):
+            entry = reader.entry(options["file"])
+            if entry is None:
+                print(f"[ERROR] No modified file entry for: {options['file']}")
+                sys.exit(1)
+            print(json.dumps(entry, indent=2, ensure_ascii=False))
+            return
+        files = reader.files(prefix or "")
+        for marker, section in (("A", "New file"), ("D", "Deleted file"), ("M", "Modified file")):
+            for path in files[section]:
+                print(f"{marker} {path}")
+
+def sbomdiff_files(old_path, new_path, options):
+    sboms = []
+    for path in (old_path, new_path):
+        try:
+            sboms.append(load_sbom(path))
+        except Exception as e:
+            print(f"[ERROR] Failed to read SBOM file '{path}': {e}")
+            sys.exit(1)
+    old_sbom, new_sbom = sboms
+    fmt = sbom_format(new_sbom)
+    if fmt is None or sbom_format(old_sbom) != fmt:
+        print("[ERROR] Both SBOMs must be CycloneDX or both SPDX documents.")
+        sys.exit(1)
+
+    changes = diff_sbom_components(old_sbom, new_sbom)
+    print(f"[INFO] Components: {len(changes['Added component'])} added, "
+          f"{len(changes['Removed component'])} removed, {len(changes['Version changed'])} version changed, "
+          f"{len(changes['Dependency changes'])} with changed dependencies")
+    # An existing upgrade section (e.g. file_changes from a diff run) is kept.
+    upgrade = new_sbom.pop("upgrade", None)
+    upgrade = upgrade if isinstance(upgrade, dict) else {}
+    upgrade["component_changes"] = {"old_sbom": str(Path(old_path).resolve()), **changes}
+    # The default name differs from a diff run's output, which is often the
+    # new SBOM passed in here.
+    output = options.get("output") or os.path.join(os.getcwd(), "sbomdiff.json")
+    write_sbom_with_upgrade(fmt, new_sbom, {"upgrade": upgrade}, output)
+
+def rename_options(options):
+    similarity = int_option(options, "rename-similarity")
+    if similarity is not None and not 0 < similarity <= 100:
+        print(f"[ERROR] --rename-similarity expects a percentage between 1 and 100, got: {similarity}")
         sys.exit(1)
+    return {
+        "renames": bool(options.get("renames")) or similarity is not None,
+        "rename_similarity": similarity,
+        "rename_limit": int_option(options, "rename-limit", RENAME_LIMIT),
+    }
+
+def ignore_rules(options):
+    """IgnoreRules from --gitignore, --exclude-from and --include-from, or None if none are set."""
+    for name in ("exclude-from", "include-from"):
+        path = options.get(name)
+        if path is not None and not os.path.isfile(path):
+            print(f"[ERROR] --{name} file not found: {path}")
+            sys.exit(1)
+    if not any(options.get(name) for name in ("gitignore", "exclude-from", "include-from")):
+        return None
+    return IgnoreRules(bool(options.get("gitignore")), options.get("exclude-from"), options.get("include-from"))
 
-    mode, fmt, old_path, new_path, tool = sys.argv[1:6]
+def diff_budget(options):
+    """A fresh DiffBudget from the budget options, or None if none are set."""
+    time_budget = options.get("time-budget")
+    if time_budget is not None:
+        try:
+            time_budget = float(time_budget)
+        except (TypeError, ValueError):
+            print(f"[ERROR] --time-budget expects a number of seconds, got: {time_budget}")
+            sys.exit(1)
+    max_file_bytes = int_option(options, "max-file-bytes")
+    max_upgrade_bytes = int_option(options, "max-upgrade-bytes")
+    if time_budget is None and max_file_bytes is None and max_upgrade_bytes is None:
+        return None
+    return DiffBudget(time_budget, max_file_bytes, max_upgrade_bytes)
+
+def diff_engine_options(options):
+    diff_engine = options.get("diff-engine", "diffoscope")
+    if diff_engine not in DIFF_ENGINES:
+        print(f"[ERROR] Unknown diff engine '{diff_engine}'. Use one of: {', '.join(DIFF_ENGINES)}")
+        sys.exit(1)
+    diffoscope_format = options.get("diffoscope-format", "text")
+    if diffoscope_format not in DIFFOSCOPE_FORMATS:
+        print(f"[ERROR] Unknown diffoscope format '{diffoscope_format}'. Use one of: {', '.join(DIFFOSCOPE_FORMATS)}")
+        sys.exit(1)
+    return diff_engine, diffoscope_format
+
+def run_job(mode, fmt, old_path, new_path, tool, options):
     fmt = fmt.lower()
     tool = tool.lower()
+    jobs = int_option(options, "jobs")
+    diff_engine, diffoscope_format = diff_engine_options(options)
 
     ensure_tool_exists(tool)
+    configure_tracing(options)
+    configure_diffoscope_library(options)
+    output = options.get("output")
+    diff_output = options.get("diff-output", "diff_output.txt")
+    hash_cache = open_hash_cache(options)
+    sbom_cache = open_sbom_cache(options)
 
     if mode == "diff":
-        if os.path.isdir(old_path) and os.path.isdir(new_path):
-            upgrade = compare_directories(old_path, new_path)
+        diff_cache = open_diff_cache(options)
+        functions = bool(options.get("functions"))
+        ignore = ignore_rules(options)
+        if is_archive_input(old_path) and is_archive_input(new_path):
+            if options.get("renames") or options.get("rename-similarity"):
+                print("[WARN] Rename detection is not supported for archives and is ignored.")
+            if options.get("gitignore"):
+                print("[WARN] --gitignore is not supported for archives; only --exclude-from/--include-from apply.")
+                ignore = ignore_rules(dict(options, gitignore=None))
+
+            def compare_changes():
+                return compare_archives(old_path, new_path, jobs=jobs, diff_engine=diff_engine,
+                                        diff_cache=diff_cache, stream=True, diffoscope_format=diffoscope_format,
+                                        functions=functions, diff_output=diff_output,
+                                        budget=diff_budget(options), ignore=ignore)
+        elif os.path.isdir(old_path) and os.path.isdir(new_path):
+            def compare_changes():
+                return compare_directories(old_path, new_path, diff_script=options.get("diff-script"),
+                                           jobs=jobs, hash_cache=hash_cache,
+                                           diff_engine=diff_engine, diff_cache=diff_cache,
+                                           stream=True, diffoscope_format=diffoscope_format,
+                                           functions=functions, diff_output=diff_output,
+                                           budget=diff_budget(options), ignore=ignore,
+                                           **rename_options(options))
         elif os.path.isfile(old_path) and os.path.isfile(new_path):
-            upgrade = compare_files(old_path, new_path)
+            def compare_changes():
+                return compare_files(old_path, new_path, diff_engine=diff_engine, diff_cache=diff_cache,
+                                     diffoscope_format=diffoscope_format, functions=functions,
+                                     diff_output=diff_output)
         else:
-            print("[ERROR] Both paths must be either files or directories.")
+            print("[ERROR] Both paths must be files, directories or archives (.tar.gz, .tar.xz, .zip).")
             sys.exit(1)
 
-        generate_sbom_with_upgrade(fmt, new_path, upgrade, tool)
+        context = int_option(options, "context")
+        compact = options.get("compact-upgrade") or context is not None
+
+        def compare():
+            upgrade = compare_changes()
+            if compact:
+                upgrade = compact_upgrade(upgrade, context)
+            return upgrade
+
+        generate_sbom_with_diff(fmt, new_path, tool, compare, sbom_cache=sbom_cache,
+                                hash_cache=hash_cache, jobs=jobs, output=output)
 
     elif mode == "user":
         upgrade_path = os.path.join(os.path.dirname(new_path), "version_upgrade.txt")
@@ -240,11 +3558,683 @@ def main():
             print(f"[ERROR] Failed to read user upgrade file '{upgrade_path}': {e}")
             sys.exit(1)
 
-        generate_sbom_with_upgrade(fmt, new_path, upgrade, tool)
+        generate_sbom_with_upgrade(fmt, new_path, upgrade, tool, sbom_cache=sbom_cache, hash_cache=hash_cache,
+                                   output=output)
 
     else:
         print("[ERROR] Unknown mode. Use 'user' or 'diff'.")
         sys.exit(1)
 
+    TRACER.finish()
+
+def _chain_labels(versions):
+    labels = [Path(v).resolve().name for v in versions]
+    if len(set(labels)) != len(labels):
+        labels = [str(i) for i in range(len(versions))]
+    return labels
+
+def run_chain(fmt, tool, versions, options):
+    """Upgrade SBOMs for every hop of an ordered version chain, plus first->last.
+
+    Each tree is walked and hashed exactly once into a content index; hop
+    and cumulative file changes are computed from those indexes. Per-file
+    diffs go through the diff cache, which is keyed by content, so a file
+    that changed in a single hop reuses that hop's diff in the cumulative
+    report.
+    """
+    fmt = fmt.lower()
+    tool = tool.lower()
+    jobs = int_option(options, "jobs")
+    diff_engine, diffoscope_format = diff_engine_options(options)
+    for version in versions:
+        if not os.path.isdir(version):
+            print(f"[ERROR] Chain versions must be directories: {version}")
+            sys.exit(1)
+
+    ensure_tool_exists(tool)
+    configure_tracing(options)
+    configure_diffoscope_library(options)
+    output_dir = options.get("output-dir") or os.getcwd()
+    os.makedirs(output_dir, exist_ok=True)
+    diff_output = options.get("diff-output", "diff_output.txt")
+    hash_cache = open_hash_cache(options)
+    sbom_cache = open_sbom_cache(options)
+    diff_cache = open_diff_cache(options)
+    functions = bool(options.get("functions"))
+    context = int_option(options, "context")
+    compact = options.get("compact-upgrade") or context is not None
+    labels = _chain_labels(versions)
+    renames = rename_options(options)
+    ignore = ignore_rules(options)
+    reports = {}
+
+    def index(version):
+        with TRACER.phase("index", tree=str(version)):
+            report = reports[version] = {}
+            return tree_index(version, jobs=jobs, hash_cache=hash_cache, rules=ignore, source_only=True,
+                              report=report)
+
+    def chain_parts(old, new, old_index, new_index):
+        parts = diff_indexes(old_index, new_index)
+        if ignore is not None:
+            parts["ignored"] = {"old": reports[old], "new": reports[new]}
+        return parts
+
+    def comparer(old, new, parts, extra=None):
+        def compare():
+            upgrade = compare_directories(old, new, jobs=jobs, hash_cache=hash_cache,
+                                          diff_engine=diff_engine, diff_cache=diff_cache, stream=True,
+                                          diffoscope_format=diffoscope_format, functions=functions,
+                                          diff_output=diff_output, parts=parts, budget=diff_budget(options),
+                                          ignore=ignore, **renames)
+            if extra:
+                upgrade["upgrade"].update(extra)
+            if compact:
+                upgrade = compact_upgrade(upgrade, context)
+            return upgrade
+        return compare
+
+    def output_for(i, j):
+        return os.path.join(output_dir, f"sbom.{fmt}_with_upgrade.{labels[i]}_to_{labels[j]}.json")
+
+    first_index = previous_index = index(versions[0])
+    sbom = None
+    for i in range(1, len(versions)):
+        current_index = index(versions[i])
+        parts = chain_parts(versions[i - 1], versions[i], previous_index, current_index)
+        print(f"[INFO] Hop {labels[i - 1]} -> {labels[i]}: {len(parts['added'])} added, "
+              f"{len(parts['removed'])} removed, {len(parts['modified'])} modified")
+        sbom = generate_sbom_with_diff(fmt, versions[i], tool, comparer(versions[i - 1], versions[i], parts),
+                                       sbom_cache=sbom_cache, hash_cache=hash_cache, jobs=jobs,
+                                       output=output_for(i - 1, i))
+        previous_index = current_index
+
+    if len(versions) > 2:
+        # The newest tree was scanned by the last hop; its SBOM is reused
+        # under a serial number and timestamp of its own.
+        parts = chain_parts(versions[0], versions[-1], first_index, previous_index)
+        print(f"[INFO] Cumulative {labels[0]} -> {labels[-1]}: {len(parts['added'])} added, "
+              f"{len(parts['removed'])} removed, {len(parts['modified'])} modified")
+        if diff_cache is None:
+            print("[INFO] No diff cache; cumulative diffs are recomputed rather than reused from the hops.")
+        chain = {"chain": [str(Path(v).resolve()) for v in versions]}
+        upgrade = comparer(versions[0], versions[-1], parts, chain)()
+        cumulative = refresh_volatile_fields(copy.deepcopy({k: v for k, v in sbom.items() if k != "upgrade"}))
+        with TRACER.phase("write"):
+            write_sbom_with_upgrade(fmt, cumulative, upgrade, output_for(0, len(versions) - 1))
+
+    TRACER.finish()
+
+def run_gitdiff(repo, old_ref, new_ref, fmt, tool, options):
+    fmt = fmt.lower()
+    tool = tool.lower()
+    jobs = int_option(options, "jobs")
+    diff_engine, diffoscope_format = diff_engine_options(options)
+    ensure_tool_exists("git")
+    ensure_tool_exists(tool)
+    configure_tracing(options)
+    configure_diffoscope_library(options)
+    if options.get("rename-similarity"):
+        print("[WARN] --rename-similarity is not supported by gitdiff; only exact renames are detected.")
+    if options.get("gitignore"):
+        print("[WARN] --gitignore does not apply to gitdiff; only --exclude-from/--include-from are used.")
+    ignore = ignore_rules(dict(options, gitignore=None))
+    hash_cache = open_hash_cache(options)
+    sbom_cache = open_sbom_cache(options)
+    diff_cache = open_diff_cache(options)
+    context = int_option(options, "context")
+    compact = options.get("compact-upgrade") or context is not None
+
+    def compare():
+        upgrade = compare_git_refs(repo, old_ref, new_ref, jobs=jobs, diff_engine=diff_engine,
+                                   diff_cache=diff_cache, stream=True, diffoscope_format=diffoscope_format,
+                                   functions=bool(options.get("functions")),
+                                   diff_output=options.get("diff-output", "diff_output.txt"),
+                                   renames=bool(options.get("renames") or options.get("rename-similarity")),
+                                   budget=diff_budget(options), ignore=ignore)
+        if compact:
+            upgrade = compact_upgrade(upgrade, context)
+        return upgrade
+
+    try:
+        with git_scan_target(repo, new_ref) as target:
+            generate_sbom_with_diff(fmt, target, tool, compare, sbom_cache=sbom_cache, hash_cache=hash_cache,
+                                    jobs=jobs, output=options.get("output"))
+    except RuntimeError as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
+    TRACER.finish()
+
+BATCH_REQUIRED_FIELDS = ("fmt", "old", "new", "tool")
+# Options that configure the batch runner itself rather than a single job.
+BATCH_OPTIONS = ("max-jobs", "job-timeout", "output-dir", "clear-cache")
+
+def load_manifest(path):
+    """Read a batch manifest: a JSON list of jobs or one JSON job per line."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+    except OSError as e:
+        print(f"[ERROR] Failed to read manifest '{path}': {e}")
+        sys.exit(1)
+    try:
+        if text.lstrip().startswith("["):
+            jobs = json.loads(text)
+        else:
+            jobs = [json.loads(line) for line in text.splitlines() if line.strip()]
+    except json.JSONDecodeError as e:
+        print(f"[ERROR] Manifest '{path}' is not valid JSON: {e}")
+        sys.exit(1)
+
+    seen = set()
+    for index, job in enumerate(jobs):
+        if not isinstance(job, dict):
+            print(f"[ERROR] Manifest entry {index} is not an object.")
+            sys.exit(1)
+        missing = [field for field in BATCH_REQUIRED_FIELDS if not job.get(field)]
+        if missing:
+            print(f"[ERROR] Manifest entry {index} is missing: {', '.join(missing)}")
+            sys.exit(1)
+        job.setdefault("mode", "diff")
+        job["id"] = str(job.get("id", index))
+        if job["id"] in seen:
+            print(f"[ERROR] Duplicate job id '{job['id']}' in manifest.")
+            sys.exit(1)
+        seen.add(job["id"])
+    return jobs
+
+def _load_progress(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"[WARN] Ignoring unreadable progress file '{path}': {e}")
+        return {}
+
+def _save_progress(path, progress):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(progress, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def _batch_job_options(job, options, output_dir, max_jobs):
+    job_options = {k: v for k, v in options.items() if k not in BATCH_OPTIONS}
+    job_options.update({k: v for k, v in job.get("options", {}).items()})
+    fmt = job["fmt"].lower()
+    job_options["output"] = job.get("output") or os.path.join(
+        output_dir, f"{job['id']}.sbom.{fmt}_with_upgrade.json")
+    job_options.setdefault("diff-output", os.path.join(output_dir, f"{job['id']}.diff_output.txt"))
+    if options.get("trace") and "trace" not in job.get("options", {}):
+        job_options["trace"] = os.path.join(output_dir, f"{job['id']}.trace.jsonl")
+    # Split the machine between concurrent jobs instead of letting every
+    # job start a full-size thread pool of its own.
+    job_options.setdefault("jobs", max(1, default_jobs() // max_jobs))
+    return job_options
+
+def _batch_worker(job, job_options, log_path):
+    # Each job leads its own process group so a timeout also takes down
+    # the scanner and diffoscope processes it started.
+    os.setsid()
+    # A rerun after a timeout starts the job's report over rather than
+    # appending to what the killed attempt left behind.
+    open(job_options["diff-output"], "w").close()
+    with open(log_path, "w", encoding="utf-8", errors="replace") as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        sys.stdout = os.fdopen(1, "w", buffering=1, encoding="utf-8", errors="replace", closefd=False)
+        sys.stderr = os.fdopen(2, "w", buffering=1, encoding="utf-8", errors="replace", closefd=False)
+        run_job(job["mode"], job["fmt"], job["old"], job["new"], job["tool"], job_options)
+        sys.stdout.flush()
+
+def _clear_batch_caches(options):
+    for opener in (open_hash_cache, open_diff_cache, open_sbom_cache):
+        opener(options)
+
+def run_batch(manifest_path, options):
+    jobs = load_manifest(manifest_path)
+    max_jobs = max(1, int_option(options, "max-jobs", 2))
+    default_timeout = options.get("job-timeout")
+    output_dir = options.get("output-dir") or os.getcwd()
+    os.makedirs(output_dir, exist_ok=True)
+    progress_path = manifest_path + ".progress.json"
+    progress = _load_progress(progress_path)
+
+    for tool in sorted({job["tool"].lower() for job in jobs}):
+        ensure_tool_exists(tool)
+    ctx = multiprocessing.get_context("fork")
+    if options.get("clear-cache"):
+        # Clear once up front; jobs clearing the shared caches while their
+        # siblings are using them would throw away each other's work. This
+        # runs in a child too, so no SQLite connection is open here when the
+        # jobs are forked.
+        sys.stdout.flush()
+        proc = ctx.Process(target=_clear_batch_caches, args=(options,))
+        proc.start()
+        proc.join()
+
+    pending = deque()
+    for job in jobs:
+        job_options = _batch_job_options(job, options, output_dir, max_jobs)
+        done = progress.get(job["id"], {})
+        if done.get("status") == "done" and os.path.exists(done.get("output", "")):
+            print(f"[INFO] Job {job['id']} already done, skipping.")
+            continue
+        pending.append((job, job_options))
+
+    running = {}
+    failed = 0
+    while pending or running:
+        while pending and len(running) < max_jobs:
+            job, job_options = pending.popleft()
+            log_path = os.path.join(output_dir, f"{job['id']}.log")
+            proc = ctx.Process(target=_batch_worker, args=(job, job_options, log_path))
+            sys.stdout.flush()
+            proc.start()
+            try:
+                timeout = float(job.get("timeout", default_timeout or 0)) or None
+            except (TypeError, ValueError):
+                timeout = None
+            running[proc.sentinel] = (proc, job, job_options, log_path, time.monotonic(), timeout)
+            print(f"[INFO] Job {job['id']} started: {job['mode']} {job['old']} -> {job['new']}")
+
+        wait_sentinels(list(running), timeout=0.5)
+        now = time.monotonic()
+        for sentinel, (proc, job, job_options, log_path, started, timeout) in list(running.items()):
+            if proc.exitcode is None:
+                if timeout is None or now - started < timeout:
+                    continue
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                # A job that has not reached its setsid() yet has no group of
+                # its own, so it is also killed by pid. The wait is bounded so
+                # a process stuck in the kernel cannot hang the batch.
+                proc.kill()
+                proc.join(timeout=5)
+                if proc.is_alive():
+                    print(f"[WARN] Job {job['id']} (pid {proc.pid}) did not exit after SIGKILL")
+                status = "timeout"
+            else:
+                proc.join()
+                status = "done" if proc.exitcode == 0 else "failed"
+            del running[sentinel]
+            elapsed = round(now - started, 3)
+            progress[job["id"]] = {"status": status, "output": job_options["output"],
+                                   "log": log_path, "exitcode": proc.exitcode, "seconds": elapsed}
+            _save_progress(progress_path, progress)
+            if status == "done":
+                print(f"[INFO] Job {job['id']} done in {elapsed}s: {job_options['output']}")
+            else:
+                failed += 1
+                print(f"[ERROR] Job {job['id']} {status} after {elapsed}s, see {log_path}")
+
+    total = sum(1 for job in jobs if progress.get(job["id"], {}).get("status") == "done")
+    print(f"[INFO] Batch finished: {total}/{len(jobs)} jobs done, {failed} failed.")
+    if failed:
+        sys.exit(1)
+
+SERVE_UNSUPPORTED_OPTIONS = ("trace", "slowest", "metrics-hook")
+SERVE_OPTIONS = ("socket", "port", "token-file", "max-jobs", "queue", "diffoscope-lib")
+CLIENT_PATH_OPTIONS = ("output", "diff-output", "diff-script", "cache-dir", "exclude-from", "include-from")
+
+def default_socket_path():
+    return os.environ.get("DIFFSBOM_SOCKET") or os.path.join(default_cache_dir(), "serve.sock")
+
+def token_file_path(options):
+    return options.get("token-file") or os.path.join(default_cache_dir(), "serve.token")
+
+def write_token_file(path):
+    # A fresh token per server start, readable only by this user: anyone
+    # who can read it may run jobs as this user.
+    token = secrets.token_hex(32)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if os.path.lexists(path):
+        os.unlink(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token + "\n")
+    return token
+
+def read_token_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+class _JobStdout(io.TextIOBase):
+    # sys.stdout while serving: what a job's request thread, and the pool
+    # threads it starts through thread_pool(), print is captured for its
+    # response; everything else goes to the server log.
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def buffer_of_caller(self):
+        return getattr(self.local, "buffer", None)
+
+    def adopt(self, buffer):
+        self.local.buffer = buffer
+
+    def write(self, text):
+        buffer = self.buffer_of_caller()
+        (buffer if buffer is not None else self.stream).write(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+class DiffServer:
+    """Job admission for one `serve` process.
+
+    At most `max_jobs` jobs run at once and at most `queue` more wait for
+    a slot. Anything beyond that is refused so that clients back off
+    instead of piling up threads.
+    """
+    def __init__(self, max_jobs, queue, stdout):
+        self.max_jobs = max_jobs
+        self.queue = queue
+        self.stdout = stdout
+        self.slots = threading.Semaphore(max_jobs)
+        self.lock = threading.Lock()
+        self.running = self.waiting = self.completed = self.rejected = 0
+
+    def status(self):
+        with self.lock:
+            return {"running": self.running, "queued": self.waiting, "completed": self.completed,
+                    "rejected": self.rejected, "max_jobs": self.max_jobs, "queue": self.queue}
+
+    def run(self, args, options):
+        """Run one job; returns (exit_code, output), or None if the server is full."""
+        with self.lock:
+            if self.running + self.waiting >= self.max_jobs + self.queue:
+                self.rejected += 1
+                return None
+            self.waiting += 1
+        with self.slots:
+            with self.lock:
+                self.waiting -= 1
+                self.running += 1
+            try:
+                return self._run_job(args, options)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+
+    def _run_job(self, args, options):
+        buffer = io.StringIO()
+        self.stdout.local.buffer = buffer
+        code = 0
+        try:
+            ignored = [f"--{name}" for name in SERVE_UNSUPPORTED_OPTIONS if name in options]
+            if ignored:
+                print(f"[WARN] {', '.join(ignored)} not supported by serve jobs; ignored.")
+            if "diffoscope-lib" in options:
+                print("[WARN] --diffoscope-lib is chosen when the server starts; ignored.")
+            options = {k: v for k, v in options.items() if k not in SERVE_UNSUPPORTED_OPTIONS + SERVE_OPTIONS}
+            # Split the machine between concurrent jobs, as batch mode does.
+            options.setdefault("jobs", max(1, default_jobs() // self.max_jobs))
+            run_job(*args, options)
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                print(e.code)
+            code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:
+            traceback.print_exc(file=buffer)
+            code = 1
+        finally:
+            self.stdout.local.buffer = None
+        return code, buffer.getvalue()
+
+class _ServeHandler(BaseHTTPRequestHandler):
+    server_version = "DiffSBOM"
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+    def log_message(self, format, *args):
+        self.server.diff.stdout.stream.write(f"[INFO] {self.address_string()} {format % args}\n")
+
+    def _reply(self, status, body, headers=()):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self):
+        # TCP servers require the token from the server's token file; the
+        # Unix socket is already restricted to this user.
+        token = self.server.token
+        if token is None:
+            return True
+        given = self.headers.get("Authorization", "")
+        if hmac.compare_digest(given.encode("utf-8", "replace"), f"Bearer {token}".encode()):
+            return True
+        self._reply(401, {"error": "missing or wrong token"})
+        return False
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path == "/status":
+            self._reply(200, self.server.diff.status())
+        else:
+            self._reply(404, {"error": f"no such endpoint: {self.path}"})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.path != "/jobs":
+            self._reply(404, {"error": f"no such endpoint: {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            args, options = request["args"], request.get("options", {})
+            if not (isinstance(args, list) and len(args) == 5 and args[0] in ("user", "diff")
+                    and all(isinstance(a, str) for a in args) and isinstance(options, dict)):
+                raise ValueError("expected args [user|diff, fmt, old_path, new_path, tool] and an options object")
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": f"bad job request: {e}"})
+            return
+        result = self.server.diff.run(args, options)
+        if result is None:
+            self._reply(503, {"error": "server busy"}, [("Retry-After", "1")])
+            return
+        code, output = result
+        self._reply(200, {"exit_code": code, "output": output})
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_path)
+
+def _server_connection(options):
+    port = int_option(options, "port")
+    if port is not None:
+        return http.client.HTTPConnection("127.0.0.1", port)
+    return _UnixHTTPConnection(options.get("socket") or default_socket_path())
+
+def run_serve(options):
+    """Serve `user`/`diff` jobs over a Unix socket, or localhost HTTP with --port.
+
+    Jobs run in this process, so tool versions, the hash, diff and SBOM
+    caches and the diffoscope library workers stay warm between them.
+    """
+    global WARM_CACHES
+    max_jobs = max(1, int_option(options, "max-jobs", 2))
+    queue = max(0, int_option(options, "queue", max_jobs * 4))
+    port = int_option(options, "port")
+    configure_diffoscope_library(options)
+    WARM_CACHES = {}
+
+    socket_path = token_path = None
+    if port is not None:
+        server = ThreadingHTTPServer(("127.0.0.1", port), _ServeHandler)
+        token_path = token_file_path(options)
+        server.token = write_token_file(token_path)
+        where = f"http://127.0.0.1:{server.server_address[1]} (token in {token_path})"
+    else:
+        socket_path = options.get("socket") or default_socket_path()
+        if os.path.exists(socket_path):
+            try:
+                _server_connection({"socket": socket_path}).connect()
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                print(f"[ERROR] A server is already listening on {socket_path}")
+                sys.exit(1)
+        os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+        # Jobs read and write files as this user, so only this user may connect.
+        umask = os.umask(0o077)
+        try:
+            server = _UnixHTTPServer(socket_path, _ServeHandler)
+        finally:
+            os.umask(umask)
+        server.token = None
+        where = socket_path
+
+    stdout = _JobStdout(sys.stdout)
+    sys.stdout = stdout
+    server.diff = DiffServer(max_jobs, queue, stdout)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"[INFO] Serving on {where} ({max_jobs} concurrent jobs, {queue} queued)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for path in (socket_path, token_path):
+            if path is not None and os.path.exists(path):
+                os.unlink(path)
+        if DIFFOSCOPE_LIBRARY is not None:
+            DIFFOSCOPE_LIBRARY.close()
+        for cache in WARM_CACHES.values():
+            if hasattr(cache, "close"):
+                cache.close()
+        sys.stdout = stdout.stream
+        print("[INFO] Server stopped")
+
+def run_client(args, options):
+    """Send a `user`/`diff` job to a running server; run it locally if there is none.
+
+    Paths are made absolute first, and the default output files are placed
+    in this directory, since the server has its own working directory.
+    """
+    server_options = {k: options.pop(k) for k in ("socket", "port", "token-file") if k in options}
+    mode, fmt, old_path, new_path, tool = args
+    args = [mode, fmt, os.path.abspath(old_path), os.path.abspath(new_path), tool]
+    for name in CLIENT_PATH_OPTIONS:
+        if isinstance(options.get(name), str):
+            options[name] = os.path.abspath(options[name])
+    options.setdefault("output", os.path.abspath(f"sbom.{fmt.lower()}_with_upgrade.json"))
+    options.setdefault("diff-output", os.path.abspath("diff_output.txt"))
+    body = json.dumps({"args": args, "options": options}).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if "port" in server_options:
+        token = read_token_file(token_file_path(server_options))
+        if token is not None:
+            headers["Authorization"] = f"Bearer {token}"
+
+    delay = 0.2
+    while True:
+        conn = _server_connection(server_options)
+        try:
+            conn.connect()
+        except OSError as e:
+            print(f"[WARN] No DiffSBOM server reachable ({e}); running the job locally.")
+            run_job(*args, options)
+            return
+        try:
+            conn.request("POST", "/jobs", body=body, headers=headers)
+            response = conn.getresponse()
+            status, reply = response.status, json.loads(response.read() or b"{}")
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            print(f"[ERROR] Lost connection to the DiffSBOM server: {e}")
+            sys.exit(1)
+        finally:
+            conn.close()
+        if status != 503:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+    if status != 200:
+        print(f"[ERROR] Server refused the job: {reply.get('error')}")
+        sys.exit(1)
+    sys.stdout.write(reply["output"])
+    if reply["exit_code"]:
+        sys.exit(reply["exit_code"])
+
+def main():
+    args, options = split_options(sys.argv[1:])
+    if args and args[0] == "expand" and len(args) in (2, 3):
+        expand_sbom_file(*args[1:])
+        return
+    if args and args[0] == "functions" and len(args) == 2:
+        print_function_index(args[1])
+        return
+    if args and args[0] == "query" and len(args) in (2, 3):
+        query_sbom(args[1], args[2] if len(args) == 3 else None, options)
+        return
+    if args and args[0] == "sbomdiff" and len(args) == 3:
+        sbomdiff_files(args[1], args[2], options)
+        return
+    if args and args[0] == "gitdiff" and len(args) in (4, 6):
+        run_gitdiff(*args[1:4], *(args[4:6] or ("cdx", "syft")), options)
+        return
+    if args and args[0] == "chain" and len(args) >= 5:
+        run_chain(args[1], args[2], args[3:], options)
+        return
+    if args and args[0] == "batch" and len(args) == 2:
+        run_batch(args[1], options)
+        return
+    if args and args[0] == "serve" and len(args) == 1:
+        run_serve(options)
+        return
+    if args and args[0] == "client" and len(args) == 6:
+        run_client(args[1:], options)
+        return
+    if len(args) < 5:
+        print("Usage:\n"
+              "  DiffSBOM.py user <cdx|spdx> <old_path> <new_path> <syft|trivy>\n"
+              "  DiffSBOM.py diff <cdx|spdx> <old_path> <new_path> <syft|trivy> [--jobs=N] [--diff-script=PATH]\n"
+              "      [--diff-engine=builtin|diffoscope|auto] [--diffoscope-format=text|json]\n"
+              "      [--cache-dir=DIR] [--no-cache] [--clear-cache] [--hash-cache-bytes=N]\n"
+              "      [--diff-cache-bytes=N] [--sbom-cache-bytes=N]\n"
+              "      [--compact-upgrade] [--context=N] [--functions]\n"
+              "      [--output=PATH] [--diff-output=PATH]\n"
+              "      [--trace[=PATH]] [--slowest=N] [--metrics-hook=MODULE:FUNCTION]\n"
+              "      [--renames] [--rename-similarity=PERCENT] [--rename-limit=N]\n"
+              "      [--diffoscope-lib] [--time-budget=SECONDS] [--max-file-bytes=N] [--max-upgrade-bytes=N]\n"
+              "      [--gitignore] [--exclude-from=FILE] [--include-from=FILE]\n"
+              "  DiffSBOM.py query <sbom.json> [path_prefix] [--file=PATH] [--rebuild-index]\n"
+              "  DiffSBOM.py sbomdiff <old_sbom.json> <new_sbom.json> [--output=PATH]\n"
+              "  DiffSBOM.py gitdiff <repo> <old-ref> <new-ref> [<cdx|spdx> <syft|trivy>]\n"
+              "  DiffSBOM.py chain <cdx|spdx> <syft|trivy> <v1> <v2> [<v3> ...] [--output-dir=DIR]\n"
+              "  DiffSBOM.py batch <manifest.json> [--max-jobs=N] [--job-timeout=SECONDS] [--output-dir=DIR]\n"
+              "  DiffSBOM.py serve [--socket=PATH | --port=N [--token-file=PATH]] [--max-jobs=N] [--queue=N] [--diffoscope-lib]\n"
+              "  DiffSBOM.py client [--socket=PATH | --port=N [--token-file=PATH]] <user|diff> <cdx|spdx> <old_path> <new_path> <syft|trivy> [...]\n"
+              "  DiffSBOM.py expand <compact_sbom.json> [output.json]\n"
+              "  DiffSBOM.py functions <diff_output.txt>")
+        sys.exit(1)
+
+    run_job(*args[:5], options)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,303 @@
+import argparse, contextlib, io, json, os, random, shutil, stat, statistics, subprocess, sys, tempfile, time, tracemalloc
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(REPO / "tasks"))
+
+import DiffSBOM
+import extract_diff_function
+
+STAGES = ("tree_diff", "file_diff_builtin", "file_diff_diffoscope", "upgrade", "sbom_json", "extract_diff",
+          "end_to_end")
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+# Stand-ins for the external tools, so the suite runs offline and measures
+# DiffSBOM rather than syft or diffoscope themselves.
+STUB_SYFT = r'''#!/usr/bin/env python3
+import json, sys, uuid
+if sys.argv[1:] in (["version"], ["--version"]):
+    print("syft 0.0.0-bench")
+    sys.exit(0)
+print(json.dumps({
+    "bomFormat": "CycloneDX", "specVersion": "1.6", "serialNumber": f"urn:uuid:{uuid.uuid4()}", "version": 1,
+    "metadata": {"timestamp": "2000-01-01T00:00:00Z", "component": {"type": "file", "name": sys.argv[1]}},
+    "components": [{"type": "library", "name": f"lib{i}", "version": "1.0.0",
+                    "purl": f"pkg:generic/lib{i}@1.0.0", "bom-ref": f"lib{i}"} for i in range(200)],
+}))
+'''
+
+STUB_DIFFOSCOPE = r'''#!/usr/bin/env python3
+import difflib, json, sys
+args = sys.argv[1:]
+if args == ["--version"]:
+    print("diffoscope 0-bench")
+    sys.exit(0)
+as_json = args[:2] == ["--json", "-"]
+old, new = args[-2:]
+with open(old, errors="replace") as f:
+    a = f.readlines()
+with open(new, errors="replace") as f:
+    b = f.readlines()
+lines = list(difflib.unified_diff(a, b, old, new, n=7))
+if as_json:
+    print(json.dumps({"diffoscope-json-version": 1, "source1": old, "source2": new,
+                      "unified_diff": "".join(lines[2:])}))
+else:
+    sys.stdout.writelines(lines)
+sys.exit(1 if lines else 0)
+'''
+
+def install_stubs(bin_dir):
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name, text in (("syft", STUB_SYFT), ("diffoscope", STUB_DIFFOSCOPE)):
+        path = bin_dir / name
+        path.write_text(text)
+        path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+
+def _source_lines(rng, count):
+    lines = []
+    for i in range(count):
+        if i % 20 == 0:
+            lines.append(f"int func_{rng.randrange(1 << 30)}(int a, int b) {{\n")
+        elif i % 20 == 19:
+            lines.append("}\n")
+        else:
+            lines.append(f"    a = a * {rng.randrange(1000)} + b; /* {rng.randrange(1 << 30):x} */\n")
+    return lines
+
+def generate_tree(root, files, modified, size, seed=0):
+    """Create old/ and new/ trees of `files` C sources of about `size` bytes.
+
+    `modified` percent of the files get a few edited, inserted and deleted
+    lines; everything else is byte-identical. Returns the (old, new) paths.
+    """
+    rng = random.Random(seed)
+    old_root, new_root = Path(root) / "old", Path(root) / "new"
+    lines_per_file = max(1, size // 48)
+    changed = set(rng.sample(range(files), int(files * modified / 100)))
+    for i in range(files):
+        rel = Path(f"dir{i % 32:02d}") / f"file{i:06d}.c"
+        lines = _source_lines(rng, lines_per_file)
+        for tree in (old_root, new_root):
+            (tree / rel.parent).mkdir(parents=True, exist_ok=True)
+        (old_root / rel).write_text("".join(lines))
+        if i in changed:
+            for _ in range(max(1, len(lines) // 100)):
+                pos = rng.randrange(len(lines))
+                op = rng.randrange(3)
+                if op == 0:
+                    lines[pos] = f"    b = {rng.randrange(1000)};\n"
+                elif op == 1:
+                    lines.insert(pos, f"    a ^= {rng.randrange(1000)};\n")
+                elif len(lines) > 1:
+                    del lines[pos]
+        (new_root / rel).write_text("".join(lines))
+    return old_root, new_root
+
+def corpus_files():
+    return sorted((REPO / "evaluation").glob("*/*.json"))
+
+def modified_pairs(old_root, new_root):
+    changes = DiffSBOM.diff_trees(old_root, new_root)
+    return [(old_root / rel, new_root / rel) for rel in changes["modified"]]
+
+def tree_bytes(*roots):
+    return sum(p.stat().st_size for root in roots for p in Path(root).rglob("*") if p.is_file())
+
+def build_stages(work, old_root, new_root):
+    """Return {stage: (callable, bytes processed, items processed)}."""
+    pairs = modified_pairs(old_root, new_root)
+    pair_bytes = sum(o.stat().st_size + n.stat().st_size for o, n in pairs)
+    corpus = corpus_files()
+    report = REPO / "tasks" / "diff_output2.txt"
+    scratch = work / "scratch"
+    scratch.mkdir(exist_ok=True)
+
+    def tree_diff():
+        DiffSBOM.diff_trees(old_root, new_root)
+
+    def file_diff(engine):
+        def run():
+            for old, new in pairs:
+                DiffSBOM.diff_capture(old, new, engine)
+        return run
+
+    def upgrade():
+        diff_output = scratch / "diff_output.txt"
+        changes = DiffSBOM.compare_directories(old_root, new_root, diff_engine="builtin",
+                                               diff_output=str(diff_output))
+        with open(scratch / "upgrade.json", "w", encoding="utf-8") as f:
+            DiffSBOM.write_json_stream(f, changes)
+        diff_output.unlink(missing_ok=True)
+
+    def sbom_json():
+        for path in corpus:
+            sbom = DiffSBOM.load_sbom(path)
+            with open(scratch / "sbom.json", "w", encoding="utf-8") as f:
+                DiffSBOM.write_json_stream(f, sbom)
+
+    def extract_diff():
+        extract_diff_function.extract_diff(str(report), False, str(scratch / "filtered_diff.txt"))
+
+    def end_to_end():
+        out = scratch / "e2e.json"
+        cmd = [sys.executable, str(REPO / "DiffSBOM.py"), "diff", "cdx", str(old_root), str(new_root), "syft",
+               "--no-cache", "--diff-engine=auto", f"--output={out}",
+               f"--diff-output={scratch / 'e2e_diff_output.txt'}"]
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            raise RuntimeError(f"end-to-end run failed with exit code {proc.returncode}")
+        (scratch / "e2e_diff_output.txt").unlink(missing_ok=True)
+        return usage.ru_maxrss
+
+    tree_files = sum(1 for root in (old_root, new_root) for p in Path(root).rglob("*") if p.is_file())
+    return {
+        "tree_diff": (tree_diff, tree_bytes(old_root, new_root), tree_files),
+        "file_diff_builtin": (file_diff("builtin"), pair_bytes, len(pairs)),
+        "file_diff_diffoscope": (file_diff("diffoscope"), pair_bytes, len(pairs)),
+        "upgrade": (upgrade, pair_bytes, len(pairs)),
+        "sbom_json": (sbom_json, sum(p.stat().st_size for p in corpus), len(corpus)),
+        "extract_diff": (extract_diff, report.stat().st_size, 1),
+        "end_to_end": (end_to_end, tree_bytes(old_root, new_root), tree_files),
+    }
+
+def measure(fn, repeat):
+    """Median of `repeat` wall times, then one traced run for peak memory.
+
+    Peak memory is the tracemalloc high-water mark of the Python heap, or
+    the child's max RSS for stages that return one (end_to_end).
+    """
+    times = []
+    peak_kib = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            child_rss = fn()
+            times.append(time.perf_counter() - start)
+        if child_rss is not None:
+            peak_kib = child_rss
+    if peak_kib is None:
+        tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                fn()
+            peak_kib = tracemalloc.get_traced_memory()[1] // 1024
+        finally:
+            tracemalloc.stop()
+    return statistics.median(times), peak_kib
+
+def run_benchmarks(stages, files, modified, size, repeat, seed):
+    work = Path(tempfile.mkdtemp(prefix="diffsbom-bench-"))
+    try:
+        install_stubs(work / "bin")
+        old_root, new_root = generate_tree(work / "tree", files, modified, size, seed)
+        available = build_stages(work, old_root, new_root)
+        results = {}
+        for name in stages:
+            fn, volume, items = available[name]
+            seconds, peak_kib = measure(fn, repeat)
+            results[name] = {
+                "seconds": round(seconds, 6),
+                "items": items,
+                "items_per_second": round(items / seconds, 2) if seconds else None,
+                "mib_per_second": round(volume / (1 << 20) / seconds, 3) if seconds else None,
+                "peak_kib": peak_kib,
+            }
+        return results
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+def compare_to_baseline(results, baseline, tolerance, min_seconds=0.05):
+    """Return a list of regression messages for stages present in both runs.
+
+    Throughput is only compared for stages that took at least `min_seconds`
+    in the baseline, and a slowdown must also add `min_seconds` of wall
+    time: timer and scheduler noise swamp stages of a few milliseconds.
+    """
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get("stages", {}).get(name)
+        if not before:
+            continue
+        timed = before.get("seconds", 0) >= min_seconds and current["seconds"] - before["seconds"] >= min_seconds
+        if timed and before.get("mib_per_second") and current["mib_per_second"] is not None:
+            floor = before["mib_per_second"] * (1 - tolerance)
+            if current["mib_per_second"] < floor:
+                regressions.append(f"{name}: throughput {current['mib_per_second']} MiB/s "
+                                   f"< {before['mib_per_second']} MiB/s baseline")
+        if before.get("peak_kib"):
+            # Small heaps are noisy; only flag growth beyond 1 MiB.
+            ceiling = max(before["peak_kib"] * (1 + tolerance), before["peak_kib"] + 1024)
+            if current["peak_kib"] > ceiling:
+                regressions.append(f"{name}: peak memory {current['peak_kib']} KiB "
+                                   f"> {before['peak_kib']} KiB baseline")
+    return regressions
+
+def print_results(results):
+    print(f"{'stage':<22}{'seconds':>10}{'items/s':>12}{'MiB/s':>10}{'peak KiB':>11}")
+    for name, r in results.items():
+        print(f"{name:<22}{r['seconds']:>10.3f}{r['items_per_second'] or 0:>12.1f}"
+              f"{r['mib_per_second'] or 0:>10.2f}{r['peak_kib']:>11}")
+
+def main():
+    """Benchmark each DiffSBOM stage and check it against a saved baseline."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark DiffSBOM on a synthetic tree and the evaluation corpus.",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"Comma-separated stages to run. Default: {','.join(STAGES)}")
+    parser.add_argument("--files", type=int, default=2000, help="Files in the synthetic tree. Default: 2000")
+    parser.add_argument("--modified", type=float, default=10,
+                        help="Percentage of synthetic files that are modified. Default: 10")
+    parser.add_argument("--size", type=int, default=8192, help="Approximate size of each file in bytes. Default: 8192")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic tree. Default: 0")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per stage; the median is kept. Default: 5")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE),
+                        help="Baseline file to compare against or save to. Default: benchmarks/baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown or memory growth before failing, as a fraction. Default: 0.2")
+    parser.add_argument("--min-seconds", type=float, default=0.05,
+                        help="Stages faster than this in the baseline, and slowdowns smaller than this,\n"
+                             "are not checked for throughput. Default: 0.05")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(unknown)}")
+
+    params = {"files": args.files, "modified": args.modified, "size": args.size, "seed": args.seed}
+    results = run_benchmarks(stages, args.files, args.modified, args.size, args.repeat, args.seed)
+    if args.json:
+        print(json.dumps({"params": params, "stages": results}, indent=2))
+    else:
+        print_results(results)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"params": params, "stages": results}, f, indent=2)
+        print(f"[INFO] Baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("params") != params:
+        print(f"[WARN] Baseline was recorded with {baseline.get('params')}; results may not be comparable.")
+    regressions = compare_to_baseline(results, baseline, args.tolerance, args.min_seconds)
+    for message in regressions:
+        print(f"[ERROR] Regression: {message}")
+    if regressions:
+        sys.exit(1)
+    print("[INFO] No regressions against the baseline.")
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,140 @@
 import argparse, re
+from collections import namedtuple
 
-def extract_diff(file: str, compressed: bool):
-    with open(file) as f:
-        lines = f.readlines()
+HEADER_RE = re.compile(r'^(-|\+){3}')
+HUNK_RE = re.compile(r'^│ @@ .+ @@$')
+HUNK_RANGE_RE = re.compile(r'@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+NESTED_OLD_RE = re.compile(r'^│   -{3} ')
+NESTED_NEW_RE = re.compile(r'├── \+{3} ')
+IDENTICAL_LINE = '│┄ Files identical despite different names\n'
 
-    recording = False
+# Event kinds produced by iter_events
+HEADER, FILES, HUNK, LINE, NESTED = "header", "files", "hunk", "line", "nested"
+
+Hunk = namedtuple("Hunk", "old_file new_file header old_start old_count new_start new_count lines")
 
-    filtered = []
+def iter_events(lines, compressed=False):
+    """Run the filter state machine over diffoscope text output.
+
+    Yields (kind, text) pairs. Concatenating the texts of every event except
+    NESTED (the ---/+++ headers of files inside an archive) gives exactly
+    the filtered report. Lines are consumed one at a time, so any iterable
+    of lines (such as an open file) works without loading it into memory.
+    """
+    recording = False
     pending = []
     for line in lines:
-        if not compressed and re.match(r'^(-|\+){3}', line):
-            filtered.append(line)
-        elif re.match(r'^│ @@ .+ @@$', line):
+        if not compressed and HEADER_RE.match(line):
+            yield HEADER, line
+        elif HUNK_RE.match(line):
             if compressed and len(pending) > 0:
-                filtered.append(''.join(pending))
+                yield FILES, ''.join(pending)
                 pending = []
-                filtered.append(line)
+                yield HUNK, line
                 recording = True
             elif not compressed:
-                filtered.append(line)
+                yield HUNK, line
                 recording = True
-        elif re.match(r'^│   -{3} ', line):
+        elif NESTED_OLD_RE.match(line):
             recording = False
             pending.append(line.replace('│   ', '', 1))
-        elif re.match(r'├── \+{3} ', line):
+            yield NESTED, pending[-1]
+        elif NESTED_NEW_RE.match(line):
             pending.append(line.replace('├── ', '', 1))
-        elif line == '│┄ Files identical despite different names\n':
+            yield NESTED, pending[-1]
+        elif line == IDENTICAL_LINE:
             pending = []
         elif recording:
-            filtered.append(line)
+            yield LINE, line
+
+def iter_hunks(lines, compressed=False, strict=False):
+    """Yield one Hunk record per hunk in diffoscope text output.
+
+    Hunk lines are returned without the box-drawing prefix and trailing
+    newline; only one hunk is held in memory at a time. A hunk ends once
+    the old and new line counts of its @@ header are used up, so whatever
+    follows it is never taken for hunk content. In compressed mode every
+    hunk of an archive member is reported, including further hunks of the
+    same member. With strict=True, a hunk cut short by the next header or
+    the end of the input raises ValueError.
+    """
+    old_file = new_file = None
+    in_member = False
+    current = None
+    old_left = new_left = 0
+    for line in lines:
+        if current is not None:
+            body = _strip_box(line)
+            in_box = line.startswith('│ ')
+            if in_box and body.startswith('\\'):
+                current.lines.append(body)
+                continue
+            if old_left > 0 or new_left > 0:
+                if in_box and body[:1] in ('', ' ', '-', '+'):
+                    if body[:1] != '+':
+                        old_left -= 1
+                    if body[:1] != '-':
+                        new_left -= 1
+                    current.lines.append(body)
+                    continue
+                if strict:
+                    raise ValueError(f"hunk {current.header!r} ends before its line counts are used up")
+            yield current
+            current = None
+        if not compressed and HEADER_RE.match(line):
+            if line.startswith('--- '):
+                old_file = line[4:].rstrip('\n')
+            else:
+                new_file = line[4:].rstrip('\n')
+        elif NESTED_OLD_RE.match(line):
+            old_file = line.replace('│   --- ', '', 1).rstrip('\n')
+            in_member = False
+        elif NESTED_NEW_RE.match(line):
+            new_file = line.replace('├── +++ ', '', 1).rstrip('\n')
+            in_member = True
+        elif line == IDENTICAL_LINE:
+            in_member = False
+        elif HUNK_RE.match(line) and (in_member or not compressed):
+            header = _strip_box(line)
+            m = HUNK_RANGE_RE.match(header)
+            old_left = 1 if m.group(2) is None else int(m.group(2))
+            new_left = 1 if m.group(4) is None else int(m.group(4))
+            current = Hunk(old_file, new_file, header,
+                           int(m.group(1)), old_left, int(m.group(3)), new_left, [])
+    if current is not None:
+        if strict and (old_left > 0 or new_left > 0):
+            raise ValueError(f"hunk {current.header!r} ends before its line counts are used up")
+        yield current
+
+def hunk_matches_header(hunk):
+    """Whether a hunk's body has exactly the old and new line counts of its header."""
+    old = sum(1 for line in hunk.lines if line[:1] in ('', ' ', '-'))
+    new = sum(1 for line in hunk.lines if line[:1] in ('', ' ', '+'))
+    return old == hunk.old_count and new == hunk.new_count
 
-    with open("filtered_diff.txt", "w") as out:
-        out.writelines(filtered)
-    print("✅ Relevant diff sections saved to filtered_diff.txt")
+def _strip_box(line):
+    line = line.rstrip('\n')
+    return line[2:] if line.startswith('│ ') else line
+
+def extract_diff(file: str, compressed: bool, output: str = "filtered_diff.txt"):
+    with open(file) as f, open(output, "w", buffering=1 << 20) as out:
+        for kind, text in iter_events(f, compressed):
+            if kind != NESTED:
+                out.write(text)
+    print(f"✅ Relevant diff sections saved to {output}")
+
+def check_hunks(file: str, compressed: bool):
+    count = 0
+    try:
+        with open(file) as f:
+            for hunk in iter_hunks(f, compressed, strict=True):
+                count += 1
+                if not hunk_matches_header(hunk):
+                    raise ValueError(f"hunk {hunk.header!r} in {hunk.new_file} does not match its header")
+    except ValueError as e:
+        print(f"❌ {e}")
+        raise SystemExit(1)
+    print(f"✅ {count} hunks match their headers")
 
 def main():
     """Main function to extract differences from diffoscope output."""
@@ -51,9 +153,22 @@ def main():
         action='store_true',
         help="Is the diffoscope output is generated from a compressed archive?"
     )
+    parser.add_argument(
+        "-o", "--output",
+        help="Where to write the filtered diff. Default is `filtered_diff.txt`",
+        default="filtered_diff.txt"
+    )
+    parser.add_argument(
+        "--check-hunks",
+        action='store_true',
+        help="Check that every hunk's body matches the line counts of its @@ header instead of extracting"
+    )
 
     args = parser.parse_args()
-    extract_diff(args.target_path, args.compressed)
+    if args.check_hunks:
+        check_hunks(args.target_path, args.compressed)
+    else:
+        extract_diff(args.target_path, args.compressed, args.output)
 
 if __name__ == "__main__":
     main()
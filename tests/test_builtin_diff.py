@@ -0,0 +1,62 @@
+import random
+import shutil
+import subprocess
+
+import pytest
+
+import DiffSBOM
+
+pytestmark = pytest.mark.skipif(shutil.which("diff") is None, reason="GNU diff not installed")
+
+ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+
+def _random_pair(rng):
+    pool = ALPHABET[:rng.choice([2, 3, 5, 10, 36])]
+    old = [rng.choice(pool) for _ in range(rng.randint(0, rng.choice([10, 40, 200])))]
+    new = list(old)
+    for _ in range(rng.randint(0, 30)):
+        pos = rng.randint(0, len(new))
+        op = rng.random()
+        if op < 0.4:
+            new[pos:pos] = [rng.choice(pool) for _ in range(rng.randint(1, 5))]
+        elif op < 0.8:
+            del new[pos:pos + rng.randint(1, 5)]
+        else:
+            new[pos:pos + 1] = [rng.choice("XYZ")]
+
+    def encode(lines):
+        if not lines:
+            return b""
+        return ("\n".join(lines) + ("\n" if rng.random() < 0.8 else "")).encode()
+    return encode(old), encode(new)
+
+
+def _gnu_diff(tmp_path, old, new):
+    old_file, new_file = tmp_path / "old", tmp_path / "new"
+    old_file.write_bytes(old)
+    new_file.write_bytes(new)
+    out = subprocess.run(["diff", "-aU7", str(old_file), str(new_file)], stdout=subprocess.PIPE).stdout
+    # Drop the ---/+++ header, which carries timestamps.
+    return out.decode().splitlines()[2:]
+
+
+def _builtin_diff(old, new):
+    return DiffSBOM.unified_diff_lines(DiffSBOM._split_lines(old), DiffSBOM._split_lines(new), "old", "new")[2:]
+
+
+def test_builtin_diff_matches_gnu_diff(tmp_path):
+    rng = random.Random(20240501)
+    for _ in range(400):
+        old, new = _random_pair(rng)
+        assert _builtin_diff(old, new) == _gnu_diff(tmp_path, old, new), (old, new)
+
+
+@pytest.mark.parametrize("old, new", [
+    (b"a\nb\n}\n", b"a\nb\n}"),
+    (b"a\nb\n}", b"a\nb\n}\n"),
+    (b"a\nb", b"a\nc"),
+    (b"x\n" * 30 + b"end", b"y\n" + b"x\n" * 29 + b"end"),
+])
+def test_missing_trailing_newline(tmp_path, old, new):
+    assert _builtin_diff(old, new) == _gnu_diff(tmp_path, old, new)
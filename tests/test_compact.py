@@ -0,0 +1,11 @@
+import DiffSBOM
+
+
+def test_context_above_engine_context_is_recorded_as_kept():
+    old = b"".join(b"%d\n" % i for i in range(40))
+    change = DiffSBOM.unified_diff_lines(DiffSBOM._split_lines(old), DiffSBOM._split_lines(old[2:]), "old", "new")
+    entry = {"file": "new", "change": list(change)}
+    upgrade = DiffSBOM.compact_upgrade({"upgrade": {"file_changes": {"Modified file": [entry]}}}, context=12)
+    assert upgrade["upgrade"]["file_changes"]["context"] == DiffSBOM.DIFF_CONTEXT_LINES
+    expanded = DiffSBOM.expand_upgrade(upgrade["upgrade"])
+    assert expanded["file_changes"]["Modified file"][0]["change"] == change
@@ -0,0 +1,37 @@
+import io
+
+import pytest
+
+import DiffSBOM
+
+
+def _make_trees(root):
+    for side in ("old", "new"):
+        for i in range(20):
+            path = root / side / f"pkg{i % 4}" / f"file{i}.c"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text("".join(f"int f{j}(void) {{ return {j if side == 'old' or j % 5 else -j}; }}\n"
+                                    for j in range(20 + 3 * i)))
+        for i in range(5):
+            name = f"added{i}.c" if side == "new" else f"removed{i}.c"
+            (root / side / name).write_text("x\n")
+    return root / "old", root / "new"
+
+
+def _section_size(upgrade):
+    out = io.StringIO()
+    DiffSBOM.write_json_stream(out, upgrade, indent=2, level=1)
+    return len(out.getvalue().encode("utf-8")) + len('\n  "upgrade": ')
+
+
+@pytest.mark.parametrize("cap", [10000, 20000, 40000])
+def test_max_upgrade_bytes_caps_whole_section(tmp_path, cap):
+    old, new = _make_trees(tmp_path)
+    budget = DiffSBOM.DiffBudget(max_upgrade_bytes=cap)
+    upgrade = DiffSBOM.compare_directories(old, new, diff_engine="builtin", budget=budget,
+                                           diff_output=str(tmp_path / "diff_output.txt"))
+    changes = upgrade["upgrade"]["file_changes"]
+    assert len(changes["New file"]) == 5 and len(changes["Deleted file"]) == 5
+    assert changes["budget"]["skipped"] > 0
+    assert any("skipped" not in e for e in changes["Modified file"])
+    assert _section_size(upgrade["upgrade"]) <= cap
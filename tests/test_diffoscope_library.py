@@ -0,0 +1,43 @@
+import importlib.util
+import shutil
+import subprocess
+
+import pytest
+
+import DiffSBOM
+
+pytestmark = pytest.mark.skipif(
+    importlib.util.find_spec("diffoscope") is None or shutil.which("diffoscope") is None,
+    reason="diffoscope not installed",
+)
+
+
+@pytest.fixture
+def library():
+    library = DiffSBOM.DiffoscopeLibrary()
+    yield library
+    library.close()
+
+
+@pytest.mark.parametrize("output_format", ["text", "json"])
+def test_library_matches_command(tmp_path, library, output_format):
+    old, new = tmp_path / "old.c", tmp_path / "new.c"
+    old.write_text("".join(f"int f{i}(void) {{ return {i}; }}\n" for i in range(40)))
+    new.write_text("".join(f"int f{i}(void) {{ return {i * (i % 9 != 0)}; }}\n" for i in range(40)) + "/* é */")
+    cmd = ["diffoscope", str(old), str(new)]
+    if output_format == "json":
+        cmd[1:1] = ["--json", "-"]
+    expected = subprocess.run(cmd, stdout=subprocess.PIPE, text=True).stdout
+    assert library.capture(old, new, output_format) == expected
+    # A second call reuses the same worker.
+    assert library.capture(old, new, output_format) == expected
+    assert len(library.workers) == 1
+
+
+def test_library_matches_command_for_directories(tmp_path, library):
+    for side, value in (("old", 1), ("new", 2)):
+        (tmp_path / side / "src").mkdir(parents=True)
+        (tmp_path / side / "src" / "a.py").write_text(f"def f():\n    return {value}\n")
+    old, new = tmp_path / "old", tmp_path / "new"
+    expected = subprocess.run(["diffoscope", str(old), str(new)], stdout=subprocess.PIPE, text=True).stdout
+    assert library.capture(old, new) == expected
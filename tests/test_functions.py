@@ -0,0 +1,56 @@
+import DiffSBOM
+
+
+def _diff(old, new, label):
+    return DiffSBOM.unified_diff_lines(DiffSBOM._split_lines(old), DiffSBOM._split_lines(new), label, label)
+
+
+def test_one_line_c_definitions():
+    old = b"int f(void) { return 1; }\nint g(void)\n{\n    return 2;\n}\nint h(void);\n"
+    new = old.replace(b"return 1;", b"return 3;")
+    assert DiffSBOM.analyze_function_changes(_diff(old, new, "a.c")) == {
+        "added": [], "removed": [], "modified": ["f"]}
+
+
+def test_c_prototypes_and_calls_are_not_definitions():
+    pattern = DiffSBOM.FUNCTION_PATTERNS["c"]
+    assert pattern.match("int h(void);") is None
+    assert pattern.match("int x = f(1);") is None
+    assert pattern.match("static int main(int argc, char **argv) {").group(2) == "main"
+    assert pattern.match("int f(void) { return 1; }").group(2) == "f"
+
+
+def test_hunk_without_section_uses_source():
+    old = b"".join(b"x = %d\n" % i for i in range(20)) + b"def foo(a):\n"
+    old += b"".join(b"    a += %d\n" % i for i in range(30)) + b"    return a\n"
+    new = old.replace(b"a += 20\n", b"a += 99\n")
+    lines = _diff(old, new, "a.py")
+    assert DiffSBOM.analyze_function_changes(lines)["modified"] == []
+    assert DiffSBOM.analyze_function_changes(lines, {"a.py": new})["modified"] == ["foo"]
+
+
+def test_diff_entry_reads_the_new_file(tmp_path):
+    old = b"".join(b"int v%d;\n" % i for i in range(20)) + b"int main(void)\n{\n"
+    old += b"".join(b"    v%d++;\n" % i for i in range(20)) + b"}\n"
+    (tmp_path / "old.c").write_bytes(old)
+    (tmp_path / "new.c").write_bytes(old.replace(b"v15++", b"v15--"))
+    _, entry = DiffSBOM._diff_entry(tmp_path / "old.c", tmp_path / "new.c", "builtin", functions=True)
+    assert entry["functions"] == {"added": [], "removed": [], "modified": ["main"]}
+
+
+def test_identical_files_get_no_entry():
+    report = [
+        "--- a.tar",
+        "+++ b.tar",
+        "├── file list",
+        "│   --- a/x.c",
+        "├── +++ b/y.c",
+        "│┄ Files identical despite different names",
+        "│   --- a/z.c",
+        "├── +++ b/z.c",
+        "│ @@ -1 +1 @@",
+        "│ -int z(void) { return 0; }",
+        "│ +int z(void) { return 1; }",
+    ]
+    assert dict(DiffSBOM.iter_function_changes(report)) == {
+        "b/z.c": {"added": [], "removed": [], "modified": ["z"]}}
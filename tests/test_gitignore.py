@@ -0,0 +1,109 @@
+import shutil
+import subprocess
+
+import pytest
+
+import DiffSBOM
+
+FILES = [
+    "a.log", "keep.log", "src/a.log", "src/keep.log", "src/main.c", "src/gen/out.c", "src/gen/keep.c",
+    "build/x.o", "src/build/y.o", "docs/build", "root.txt", "src/root.txt",
+    "a/b/c/deep.tmp", "a/deep.tmp", "foo/x/y/bar/z.c", "foo/bar/z.c", "bar/z.c", "logs/2024/app.txt",
+    "nested/inner/secret.key", "nested/inner/public.key", "nested/other/secret.key", "nested/secret.key",
+    "space .txt", "literal#.txt", "#hash.txt", "!bang.txt",
+]
+
+GITIGNORES = {
+    ".gitignore": "\n".join([
+        "# comment",
+        "*.log",
+        "!keep.log",
+        "/root.txt",
+        "build/",
+        "**/deep.tmp",
+        "foo/**/z.c",
+        "logs/**",
+        "space\\ .txt",
+        "\\#hash.txt",
+        "\\!bang.txt",
+    ]) + "\n",
+    "src/.gitignore": "gen/*\n!gen/keep.c\n!a.log\n",
+    "nested/.gitignore": "*.key\n",
+    "nested/inner/.gitignore": "!public.key\n",
+}
+
+
+def _make_tree(root):
+    for rel in FILES:
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if not path.exists():
+            path.write_text(rel + "\n")
+    for rel, text in GITIGNORES.items():
+        (root / rel).write_text(text)
+    return root
+
+
+def _kept(root):
+    return set(DiffSBOM.walk_tree(root, DiffSBOM.IgnoreRules(gitignore=True)))
+
+
+EXPECTED_EXCLUDED = {
+    "a.log", "src/gen/out.c", "build/x.o", "src/build/y.o", "root.txt",
+    "a/b/c/deep.tmp", "a/deep.tmp", "foo/x/y/bar/z.c", "foo/bar/z.c", "logs/2024/app.txt",
+    "nested/inner/secret.key", "nested/other/secret.key", "nested/secret.key", "space .txt", "#hash.txt",
+    "!bang.txt",
+}
+
+
+def test_walk_tree_applies_nested_gitignores(tmp_path):
+    root = _make_tree(tmp_path)
+    kept = _kept(root)
+    assert kept == (set(FILES) | set(GITIGNORES)) - EXPECTED_EXCLUDED
+    # A directory-only pattern does not match a file of that name.
+    assert "src/build/y.o" not in kept and "docs/build" in kept
+    # Negation in a deeper .gitignore overrides a shallower rule.
+    assert "src/a.log" in kept and "nested/inner/public.key" in kept
+    # Anchored patterns only match at their own level.
+    assert "root.txt" not in kept and "src/root.txt" in kept
+    # `**` matches zero or more directories.
+    assert "bar/z.c" in kept
+
+
+def test_path_excluded_agrees_with_walk(tmp_path):
+    root = _make_tree(tmp_path)
+    rules = DiffSBOM.IgnoreRules(gitignore=True)
+    kept = _kept(root)
+    for rel in FILES:
+        assert rules.path_excluded(rel, root) == (rel not in kept), rel
+
+
+def test_excluded_directory_is_not_reopened_by_negation(tmp_path):
+    root = tmp_path
+    (root / "vendor" / "lib").mkdir(parents=True)
+    (root / "vendor" / "lib" / "a.c").write_text("")
+    (root / ".gitignore").write_text("vendor/\n!vendor/lib/a.c\n")
+    assert "vendor/lib/a.c" not in _kept(root)
+
+
+def test_include_file_reaches_into_excluded_directory(tmp_path):
+    root = tmp_path / "tree"
+    (root / "vendor" / "mylib").mkdir(parents=True)
+    (root / "vendor" / "other").mkdir()
+    (root / "vendor" / "mylib" / "a.c").write_text("")
+    (root / "vendor" / "other" / "b.c").write_text("")
+    exclude, include = tmp_path / "exclude", tmp_path / "include"
+    exclude.write_text("vendor/\n")
+    include.write_text("vendor/mylib/\n")
+    rules = DiffSBOM.IgnoreRules(exclude_from=str(exclude), include_from=str(include))
+    assert set(DiffSBOM.walk_tree(root, rules)) == {"vendor/mylib/a.c"}
+    assert not rules.path_excluded("vendor/mylib/a.c") and rules.path_excluded("vendor/other/b.c")
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git not installed")
+def test_walk_tree_matches_git(tmp_path):
+    root = _make_tree(tmp_path)
+    subprocess.run(["git", "init", "-q", str(root)], check=True)
+    out = subprocess.run(["git", "-C", str(root), "ls-files", "--others", "--exclude-standard", "-z"],
+                         check=True, stdout=subprocess.PIPE).stdout
+    assert _kept(root) == {name for name in out.decode().split("\0") if name}
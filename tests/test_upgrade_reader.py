@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+import DiffSBOM
+
+
+@pytest.fixture(autouse=True)
+def always_index(monkeypatch):
+    monkeypatch.setattr(DiffSBOM.UpgradeReader, "INDEX_MIN_BYTES", 0)
+
+
+def _write(path, sbom):
+    with open(path, "w", encoding="utf-8") as f:
+        DiffSBOM.write_json_stream(f, sbom, indent=2)
+    return path
+
+
+def _sbom(entries, new=(), deleted=()):
+    return {
+        "bomFormat": "CycloneDX",
+        "components": [{"name": "file\"changes\"", "properties": [{"name": "upgrade", "value": "]}{["}]}],
+        "upgrade": {"file_changes": {"old_version": "/old", "New file": list(new), "Deleted file": list(deleted),
+                                     "Modified file": entries}},
+    }
+
+
+ENTRIES = [
+    {"file": "/src/quote\"and\\backslash.c", "change": ["--- a", "+++ b", "@@ -1 +1 @@", "-\"x\\\"\"", "+\t}{]["]},
+    {"file": "/src/ünïcødé/日本語.py", "change": ["--- a", "+++ b", "@@ -1 +1 @@", "-€", "+\U0001f600  "]},
+    {"file": "/src/nested.c", "change": [], "skipped": "time budget exhausted",
+     "functions": [{"name": "f", "hunks": [[1, {"deep": ["[", "{"]}]]}]},
+]
+
+
+def _expected(path):
+    with open(path, encoding="utf-8") as f:
+        changes = json.load(f)["upgrade"]["file_changes"]
+    return changes, {e["file"]: e for e in changes["Modified file"]}
+
+
+@pytest.mark.parametrize("ensure_ascii", [False, True])
+def test_reader_matches_json_load(tmp_path, ensure_ascii):
+    path = tmp_path / "sbom.json"
+    sbom = _sbom(ENTRIES, new=["/src/new \"file\".c"], deleted=["/src/gone\\.c", "/src/ß.c"])
+    if ensure_ascii:
+        path.write_text(json.dumps(sbom, indent=2, ensure_ascii=True), encoding="utf-8")
+    else:
+        _write(path, sbom)
+    changes, by_file = _expected(path)
+    with DiffSBOM.UpgradeReader(path) as reader:
+        files = reader.files()
+        assert files["New file"] == changes["New file"]
+        assert files["Deleted file"] == changes["Deleted file"]
+        assert files["Modified file"] == sorted(by_file)
+        for name, entry in by_file.items():
+            assert reader.entry(name) == entry
+    assert (tmp_path / "sbom.json.idx").exists()
+
+
+def test_reader_without_indent(tmp_path):
+    path = tmp_path / "sbom.json"
+    path.write_text(json.dumps(_sbom(ENTRIES)), encoding="utf-8")
+    _, by_file = _expected(path)
+    with DiffSBOM.UpgradeReader(path) as reader:
+        assert {name: reader.entry(name) for name in reader.files()["Modified file"]} == by_file
+
+
+def test_reader_expands_compact_entries(tmp_path):
+    entries = [{"file": f"/src/{n}.c", "change": ["--- a", "+++ b", "@@ -1,2 +1,2 @@ int main()", " x", "-y", "+z"]}
+               for n in ("a", "b")]
+    path = tmp_path / "sbom.json"
+    sbom = _sbom([dict(e) for e in entries])
+    sbom["upgrade"] = DiffSBOM.compact_upgrade({"upgrade": sbom["upgrade"]})["upgrade"]
+    _write(path, sbom)
+    with DiffSBOM.UpgradeReader(path) as reader:
+        assert [reader.entry(e["file"]) for e in entries] == entries
+
+
+def test_small_file_fallback_matches_index(tmp_path, monkeypatch):
+    path = tmp_path / "sbom.json"
+    _write(path, _sbom(ENTRIES, new=["/n"]))
+    with DiffSBOM.UpgradeReader(path) as reader:
+        indexed = reader.files(), {e["file"]: reader.entry(e["file"]) for e in ENTRIES}
+    (tmp_path / "sbom.json.idx").unlink()
+    monkeypatch.setattr(DiffSBOM.UpgradeReader, "INDEX_MIN_BYTES", 1 << 30)
+    with DiffSBOM.UpgradeReader(path) as reader:
+        assert (reader.files(), {e["file"]: reader.entry(e["file"]) for e in ENTRIES}) == indexed
+    assert not (tmp_path / "sbom.json.idx").exists()
+
+
+@pytest.mark.parametrize("small", [False, True])
+def test_truncated_file_is_rejected(tmp_path, monkeypatch, small):
+    if small:
+        monkeypatch.setattr(DiffSBOM.UpgradeReader, "INDEX_MIN_BYTES", 1 << 30)
+    path = tmp_path / "sbom.json"
+    _write(path, _sbom(ENTRIES))
+    text = path.read_bytes()
+    path.write_bytes(text[:text.index(b"nested.c")])
+    with pytest.raises(ValueError):
+        json.loads(path.read_bytes())
+    with pytest.raises(ValueError):
+        DiffSBOM.UpgradeReader(path, rebuild=True)